@@ -1,25 +1,103 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated
+
 from fastapi import FastAPI
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from textblob import TextBlob
 
-app = FastAPI(title="Game Guide AI Predictor")
+from sentiment_cache import SentimentCache, text_key
+
+# Batch scoring runs in a process pool so a big batch uses spare cores instead
+# of the request thread; single predictions stay in-process and never queue
+# behind a batch. 0 workers scores batches inline too.
+PREDICT_WORKERS = int(os.getenv("AI_PREDICT_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# Batches with up to this many uncached texts are cheaper to score inline
+# than to ship to the pool.
+BATCH_INLINE_MAX = int(os.getenv("AI_BATCH_INLINE_MAX", "32"))
+# Request-size limits for /api/predict/batch; a batch with a longer text is
+# rejected (422) as a whole rather than scored on a cut-down text.
+BATCH_MAX_TEXTS = int(os.getenv("AI_BATCH_MAX_TEXTS", "500"))
+TEXT_MAX_CHARS = int(os.getenv("AI_TEXT_MAX_CHARS", "5000"))
+
+_pool = None
+cache = SentimentCache()
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PREDICT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the workers (each imports TextBlob) in the background now rather
+    # than on the first batch request.
+    if PREDICT_WORKERS > 0:
+        _get_pool().map(analyze, [""] * PREDICT_WORKERS)
+    yield
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+    cache.close()
+
+app = FastAPI(title="Game Guide AI Predictor", lifespan=lifespan)
 
 class ReviewData(BaseModel):
     text: str
 
-@app.post("/api/predict")
-def predict_sentiment(review: ReviewData):
-    analysis = TextBlob(review.text)
+class ReviewBatch(BaseModel):
+    texts: list[Annotated[str, Field(max_length=TEXT_MAX_CHARS)]] = Field(..., min_length=1, max_length=BATCH_MAX_TEXTS)
+
+def analyze(text: str) -> tuple:
+    analysis = TextBlob(text)
     score = analysis.sentiment.polarity
-    
+
     if score > 0.2:
         sentiment = "HAPPY"
     elif score < -0.2:
         sentiment = "ANGRY"
     else:
         sentiment = "NEUTRAL"
-        
-    return {
-        "sentiment": sentiment,
-        "score": round(score, 2)
-    }
\ No newline at end of file
+
+    return score, sentiment
+
+def score_texts(texts: list) -> list:
+    """Responses for texts, in order. Cached texts and repeats within the call
+    are answered without running the analyzer."""
+    keys = [text_key(t) for t in texts]
+    found, todo = {}, {}
+    for key, text in zip(keys, texts):
+        if key in found or key in todo:
+            continue
+        value = cache.get(key)
+        if value is None:
+            todo[key] = text
+        else:
+            found[key] = value
+
+    if todo:
+        if PREDICT_WORKERS <= 0 or len(todo) <= BATCH_INLINE_MAX:
+            results = [analyze(t) for t in todo.values()]
+        else:
+            chunksize = max(1, len(todo) // (PREDICT_WORKERS * 4))
+            results = list(_get_pool().map(analyze, todo.values(), chunksize=chunksize))
+        fresh = dict(zip(todo, results))
+        cache.put_many(fresh)
+        found.update(fresh)
+
+    return [{"sentiment": found[k][1], "score": round(found[k][0], 2)} for k in keys]
+
+@app.post("/api/predict")
+def predict_sentiment(review: ReviewData):
+    return score_texts([review.text])[0]
+
+@app.post("/api/predict/batch")
+def predict_sentiment_batch(batch: ReviewBatch):
+    items = score_texts(batch.texts)
+    return {"count": len(items), "items": items}
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    return cache.stats()
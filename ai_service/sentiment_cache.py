@@ -0,0 +1,114 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# Results keyed by a hash of the normalized text, so repeats ("gg", duplicate
+# submissions, edits that only touch whitespace) skip the analyzer. Memory
+# holds the most recently used entries; with AI_CACHE_PATH set, every result
+# is also written to a local SQLite file that backs memory misses and survives
+# restarts. The file keeps the last AI_CACHE_DISK_MAX_ENTRIES results written.
+CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "10000"))
+CACHE_PATH = os.getenv("AI_CACHE_PATH", "")
+CACHE_DISK_MAX_ENTRIES = int(os.getenv("AI_CACHE_DISK_MAX_ENTRIES", "200000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+def text_key(text: str) -> str:
+    # TextBlob tokenizes on whitespace, so collapsing it can't change a score;
+    # case and punctuation can, and are kept.
+    normalized = _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SentimentCache:
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, path: str = CACHE_PATH,
+                 disk_max_entries: int = CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self.path = path or None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Memory and disk have separate locks, so memory hits never wait on
+        # SQLite reads, writes or commits.
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        if self.path and self.max_entries > 0:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sentiment (key TEXT PRIMARY KEY, polarity REAL, sentiment TEXT)")
+            self._db.commit()
+
+    def get(self, key: str):
+        """(polarity, sentiment) or None."""
+        if self.max_entries <= 0:
+            self.misses += 1
+            return None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        row = None
+        with self._db_lock:
+            if self._db is not None:
+                row = self._db.execute("SELECT polarity, sentiment FROM sentiment WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self._remember(key, (row[0], row[1]))
+            self.disk_hits += 1
+            return row[0], row[1]
+
+    def put_many(self, items: dict):
+        """items: key -> (polarity, sentiment)."""
+        if self.max_entries <= 0 or not items:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.executemany("INSERT OR REPLACE INTO sentiment VALUES (?, ?, ?)",
+                                 [(k, p, s) for k, (p, s) in items.items()])
+            if self.disk_max_entries > 0:
+                # A (re)written row gets the next rowid: drop all but the
+                # newest disk_max_entries.
+                self._db.execute("DELETE FROM sentiment WHERE rowid <= (SELECT MAX(rowid) FROM sentiment) - ?",
+                                 (self.disk_max_entries,))
+            self._db.commit()
+
+    def _remember(self, key: str, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "persistent": self._db is not None,
+            "disk_max_entries": self.disk_max_entries if self._db is not None else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+        }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
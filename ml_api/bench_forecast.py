@@ -0,0 +1,228 @@
+"""Offline benchmark for the forecast/recommendation pipeline.
+
+Generates a synthetic shop (product / order / order_item) into a local SQLite
+file, points db.engine at it and times every stage, recording peak Python
+memory (tracemalloc) per stage. Results go to a JSON file so runs can be
+compared across commits.
+
+    cd ml_api
+    python bench_forecast.py --products 1000 --days 90
+    python bench_forecast.py --products 100000 --days 730 --orders-per-day 20000 --stages daily,features
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import sqlite3
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+STAGES = ["sync_rollup", "build_daily_sales", "features", "train", "refresh_forecasts", "refresh_recommendations"]
+
+
+# ---------------- Synthetic data ----------------
+SCHEMA = [
+    "CREATE TABLE product (id INTEGER PRIMARY KEY, category TEXT, stock INTEGER)",
+    "CREATE TABLE `order` (id INTEGER PRIMARY KEY, created_at TIMESTAMP)",
+    "CREATE TABLE order_item (id INTEGER PRIMARY KEY, order_ref_id INTEGER, product_id INTEGER, quantity INTEGER)",
+    "CREATE TABLE product_forecast (id INTEGER PRIMARY KEY, product_id INTEGER, forecast_days INTEGER,"
+    " predicted_qty REAL, recommended_reorder_qty INTEGER, generated_at TIMESTAMP, UNIQUE(product_id, forecast_days))",
+    "CREATE TABLE product_recommendation (id INTEGER PRIMARY KEY, product_id INTEGER, recommended_product_id INTEGER,"
+    " score REAL, generated_at TIMESTAMP, UNIQUE(product_id, recommended_product_id))",
+]
+
+def generate_shop(path: str, n_products: int, days: int, orders_per_day: int, seed: int = 42) -> dict:
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    for ddl in SCHEMA:
+        conn.execute(ddl)
+
+    categories = np.array(["Games", "Consoles", "Accessories", "Merch", "Gift cards"])
+    conn.executemany("INSERT INTO product VALUES (?, ?, ?)", zip(
+        range(1, n_products + 1),
+        categories[rng.integers(0, len(categories), n_products)].tolist(),
+        rng.integers(0, 200, n_products).tolist(),
+    ))
+
+    # Long-tail popularity, like a real catalog.
+    weights = 1.0 / np.arange(1, n_products + 1) ** 1.1
+    weights /= weights.sum()
+
+    n_orders = days * orders_per_day
+    start = datetime.now() - timedelta(days=days)
+    offsets = np.sort(rng.integers(0, days * 86400, n_orders))
+    item_id = 1
+    chunk = 200_000
+    for lo in range(0, n_orders, chunk):
+        hi = min(lo + chunk, n_orders)
+        order_ids = np.arange(lo + 1, hi + 1)
+        conn.executemany("INSERT INTO `order` VALUES (?, ?)", zip(
+            order_ids.tolist(),
+            [(start + timedelta(seconds=int(s))).isoformat(sep=" ") for s in offsets[lo:hi]],
+        ))
+        lines = rng.integers(1, 4, hi - lo)
+        item_orders = np.repeat(order_ids, lines)
+        item_products = rng.choice(n_products, size=len(item_orders), p=weights) + 1
+        item_qty = rng.integers(1, 4, len(item_orders))
+        conn.executemany("INSERT INTO order_item VALUES (?, ?, ?, ?)", zip(
+            range(item_id, item_id + len(item_orders)),
+            item_orders.tolist(), item_products.tolist(), item_qty.tolist(),
+        ))
+        item_id += len(item_orders)
+
+    conn.commit()
+    conn.close()
+    return {"products": n_products, "days": days, "orders": n_orders, "order_items": item_id - 1}
+
+
+def mysql_to_sqlite(engine):
+    """Translate the MySQL upsert dialect used by ml_api into SQLite's."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def _rewrite(conn, cursor, statement, params, context, executemany):
+        statement = statement.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET")
+        statement = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", statement)
+        return statement, params
+
+
+# ---------------- Measurement ----------------
+def measure(name: str, fn, results: dict):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        out = fn()
+        error = None
+    except Exception as e:
+        out, error = None, f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results[name] = {"seconds": round(seconds, 4), "peak_mb": round(peak / 2**20, 2)}
+    if error:
+        results[name]["error"] = error
+    print(f"{name:<24} {seconds:9.3f}s  peak {peak / 2**20:9.1f} MB" + (f"  ERROR {error}" if error else ""))
+    return out
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--products", type=int, default=1000)
+    ap.add_argument("--days", type=int, default=90)
+    ap.add_argument("--orders-per-day", type=int, default=None, help="default: products / 2")
+    ap.add_argument("--horizons", default="7,14,30")
+    ap.add_argument("--train-budget", type=float, default=60.0, help="seconds for the model search")
+    ap.add_argument("--stages", default=",".join(STAGES))
+    ap.add_argument("--workdir", default=None, help="keep the SQLite file and stores here (default: temp dir)")
+    ap.add_argument("--out", default=None, help="result JSON (default: <workdir>/bench-<timestamp>.json)")
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args(argv)
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        ap.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ml_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    db_path = os.path.join(workdir, f"shop-{args.products}p-{args.days}d-{args.seed}.sqlite")
+    orders_per_day = args.orders_per_day or max(1, args.products // 2)
+
+    # Everything below imports db.engine: point it at SQLite and keep model and
+    # rollup files out of the real ML_MODEL_DIR / ML_DATA_DIR.
+    os.environ["ML_DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["ML_MODEL_DIR"] = os.path.join(workdir, "models")
+    os.environ["ML_DATA_DIR"] = os.path.join(workdir, "data")
+    # SQLite has no RENAME TABLE swap: rebuild recommendations in place.
+    os.environ["ML_RECO_PUBLISH"] = "delete"
+
+    results = {}
+    t0 = time.perf_counter()
+    if not os.path.exists(db_path):
+        shop = measure("generate", lambda: generate_shop(db_path, args.products, args.days, orders_per_day, args.seed), results)
+    else:
+        shop = None
+
+    import pandas as pd
+    from sqlalchemy import text
+    import db
+    mysql_to_sqlite(db.engine)
+    import sales_rollup
+    import forecast
+    import recommendations
+
+    since = datetime.now() - timedelta(days=args.days + 1)
+    horizons = [int(h) for h in args.horizons.split(",") if h]
+
+    if "sync_rollup" in stages:
+        measure("sync_rollup", lambda: sales_rollup.sync_daily_sales(rebuild=True)["rows"], results)
+
+    df_daily = None
+    if "build_daily_sales" in stages:
+        with db.engine.connect() as conn:
+            items = pd.DataFrame(conn.execute(text("""
+                SELECT oi.product_id, o.created_at, oi.quantity
+                FROM order_item oi INNER JOIN `order` o ON o.id = oi.order_ref_id
+            """)).fetchall(), columns=["product_id", "created_at", "quantity"])
+        df_daily = measure("build_daily_sales", lambda: sales_rollup.build_daily_sales(items), results)
+        del items
+
+    if "features" in stages:
+        if df_daily is None:
+            df_daily = sales_rollup.load_daily_sales(since)
+        measure("features", lambda: forecast.build_training_rows_v2(df_daily, 30), results)
+
+    if "train" in stages:
+        measure("train", lambda: forecast.train_forecast_model(args.days, 30, time_budget_s=args.train_budget), results)
+
+    if "refresh_forecasts" in stages:
+        measure("refresh_forecasts", lambda: forecast.refresh_forecasts(lookback_days=args.days, horizons=horizons, full=True), results)
+
+    if "refresh_recommendations" in stages:
+        measure("refresh_recommendations", lambda: recommendations.refresh_recommendations(6, rebuild=True), results)
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {**vars(args), "orders_per_day": orders_per_day},
+        "shop": shop,
+        "stages": results,
+        "total_seconds": round(time.perf_counter() - t0, 3),
+        # ru_maxrss is KiB on Linux; child processes (model search pool) are not included.
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    out = args.out or os.path.join(workdir, f"bench-{datetime.now():%Y%m%dT%H%M%S}.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"results: {out}")
+    return report
+
+def failed_stages(report: dict) -> list:
+    return [name for name, r in report["stages"].items() if "error" in r]
+
+
+if __name__ == "__main__":
+    # The report is written either way; a failed stage still fails the run.
+    failed = failed_stages(main())
+    if failed:
+        print(f"failed stages: {', '.join(failed)}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import text
+
+from db import BULK_LOAD_DATA
+
+
+BULK_CHUNK_SIZE = int(os.getenv("ML_BULK_CHUNK_SIZE", "1000"))
+
+
+def _multi_row_upsert(table: str, columns: list, update_columns: list, n_rows: int):
+    values = ",".join(
+        "(" + ",".join(f":{c}_{i}" for c in columns) + ")" for i in range(n_rows)
+    )
+    sql = f"INSERT INTO {table} ({','.join(columns)}) VALUES {values}"
+    if update_columns:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c}=VALUES({c})" for c in update_columns)
+    return text(sql)
+
+def _tsv_value(v) -> str:
+    if v is None:
+        return "\\N"
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d %H:%M:%S")
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _upsert_values(conn, table, columns, rows, update_columns, chunk_size) -> int:
+    stmts = {}
+    chunks = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        stmt = stmts.get(len(chunk))
+        if stmt is None:
+            stmt = stmts[len(chunk)] = _multi_row_upsert(table, columns, update_columns, len(chunk))
+        params = {f"{c}_{i}": r[c] for i, r in enumerate(chunk) for c in columns}
+        conn.execute(stmt, params)
+        chunks += 1
+    return chunks
+
+def _upsert_load_data(conn, table, columns, rows, update_columns, chunk_size) -> int:
+    # LOAD DATA can't upsert by itself: load into a session temp table, then
+    # merge with one INSERT ... SELECT ... ON DUPLICATE KEY UPDATE.
+    staging = f"tmp_{table}_load"
+    cols = ",".join(columns)
+    conn.execute(text(f"DROP TEMPORARY TABLE IF EXISTS {staging}"))
+    conn.execute(text(f"CREATE TEMPORARY TABLE {staging} LIKE {table}"))
+
+    chunks = 0
+    for start in range(0, len(rows), chunk_size):
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, encoding="utf-8") as f:
+            for r in rows[start:start + chunk_size]:
+                f.write("\t".join(_tsv_value(r[c]) for c in columns) + "\n")
+            path = f.name
+        try:
+            conn.execute(text(f"LOAD DATA LOCAL INFILE :path INTO TABLE {staging} ({cols})"), {"path": path})
+        finally:
+            os.unlink(path)
+        chunks += 1
+
+    sql = f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging}"
+    if update_columns:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c}=VALUES({c})" for c in update_columns)
+    conn.execute(text(sql))
+    conn.execute(text(f"DROP TEMPORARY TABLE {staging}"))
+    return chunks
+
+
+def bulk_upsert(conn, table: str, columns: list, rows: list, update_columns: list = None,
+                chunk_size: int = None, use_load_data: bool = None) -> dict:
+    """Write dict rows into table in chunks of multi-row INSERT ... ON DUPLICATE
+    KEY UPDATE (or LOAD DATA when ML_BULK_LOAD_DATA=1). Runs on the caller's
+    connection, so it shares the caller's transaction."""
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    use_load_data = BULK_LOAD_DATA if use_load_data is None else use_load_data
+
+    t0 = time.perf_counter()
+    if not rows:
+        chunks = 0
+    elif use_load_data:
+        chunks = _upsert_load_data(conn, table, columns, rows, update_columns or [], chunk_size)
+    else:
+        chunks = _upsert_values(conn, table, columns, rows, update_columns or [], chunk_size)
+    seconds = time.perf_counter() - t0
+
+    return {
+        "table": table,
+        "rows": len(rows),
+        "chunks": chunks,
+        "method": "load_data" if use_load_data and rows else "insert_values",
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(len(rows) / seconds, 1) if seconds > 0 else None,
+    }
+
+
+def _foreign_keys(conn, table: str) -> list:
+    ddl = conn.execute(text(f"SHOW CREATE TABLE {table}")).fetchone()[1]
+    return [line.strip().rstrip(",") for line in re.findall(r"^\s*CONSTRAINT .+ FOREIGN KEY .+$", ddl, re.M)]
+
+def _orphan_rows(conn, table: str, fk: str) -> int:
+    """Rows of table whose foreign key columns (all non-NULL) match no parent row."""
+    cols, parent, parent_cols = re.search(r"FOREIGN KEY \(([^)]+)\) REFERENCES (\S+) \(([^)]+)\)", fk).groups()
+    cols, parent_cols = [c.strip() for c in cols.split(",")], [c.strip() for c in parent_cols.split(",")]
+    on = " AND ".join(f"p.{pc} = t.{c}" for c, pc in zip(cols, parent_cols))
+    filled = " AND ".join(f"t.{c} IS NOT NULL" for c in cols)
+    return conn.execute(text(
+        f"SELECT COUNT(*) FROM {table} t LEFT JOIN {parent} p ON {on} WHERE {filled} AND p.{parent_cols[0]} IS NULL"
+    )).scalar()
+
+# Full rebuilds of one table run one at a time (MySQL named lock); a second
+# one waits up to this long for the first to finish.
+REPLACE_LOCK_TIMEOUT_S = int(os.getenv("ML_REPLACE_LOCK_TIMEOUT_S", "600"))
+
+def replace_table(engine, table: str, columns: list, rows: list, chunk_size: int = None,
+                  use_load_data: bool = None) -> dict:
+    """Replace every row of table without readers ever blocking on the load or
+    seeing it half done: rows go into a shadow copy in short per-chunk
+    transactions, then one RENAME TABLE swaps it in atomically. A failure
+    before the swap drops the shadow and leaves the live table untouched.
+
+    CREATE TABLE ... LIKE copies columns and indexes but not foreign keys:
+    the loaded rows are checked against each parent table (anti-join) before
+    the swap, and the keys are re-added under their old names after it.
+    """
+    lock = f"replace_table:{table}"
+    with engine.connect() as lock_conn:
+        got = lock_conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                {"name": lock, "timeout": REPLACE_LOCK_TIMEOUT_S}).scalar()
+        if got != 1:
+            raise RuntimeError(f"Another rebuild of {table} is still running")
+        try:
+            return _replace_table_locked(engine, table, columns, rows, chunk_size, use_load_data)
+        finally:
+            lock_conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": lock})
+
+def _replace_table_locked(engine, table, columns, rows, chunk_size, use_load_data) -> dict:
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    shadow, retired = f"{table}_shadow", f"{table}_retired"
+
+    t0 = time.perf_counter()
+    with engine.begin() as conn:
+        foreign_keys = _foreign_keys(conn, table)
+        # Leftovers of a run that died mid-way; the lock rules out a live one.
+        conn.execute(text(f"DROP TABLE IF EXISTS {shadow}, {retired}"))
+        conn.execute(text(f"CREATE TABLE {shadow} LIKE {table}"))
+
+    chunks = 0
+    method = None
+    try:
+        for start in range(0, len(rows), chunk_size):
+            with engine.begin() as conn:
+                info = bulk_upsert(conn, shadow, columns, rows[start:start + chunk_size],
+                                   chunk_size=chunk_size, use_load_data=use_load_data)
+            chunks += info["chunks"]
+            method = info["method"]
+        # The keys are re-added with checks off, so nothing else would catch
+        # a row pointing at a deleted parent: check each one before the swap.
+        with engine.connect() as conn:
+            for fk in foreign_keys:
+                orphans = _orphan_rows(conn, shadow, fk)
+                if orphans:
+                    raise RuntimeError(f"{orphans} new {table} rows break {fk}; {table} was left as it was")
+    except Exception:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {shadow}"))
+        raise
+    load_seconds = time.perf_counter() - t0
+
+    with engine.begin() as conn:
+        conn.execute(text(f"RENAME TABLE {table} TO {retired}, {shadow} TO {table}"))
+        conn.execute(text(f"DROP TABLE {retired}"))
+    if foreign_keys:
+        with engine.begin() as conn:
+            # The shadow had no foreign keys while loading; with checks off the
+            # ALTER adds them in place instead of copying the whole table.
+            # Restored before the connection goes back to the pool.
+            conn.execute(text("SET foreign_key_checks = 0"))
+            try:
+                conn.execute(text(f"ALTER TABLE {table} " + ", ".join(f"ADD {fk}" for fk in foreign_keys)))
+            except Exception as e:
+                raise RuntimeError(
+                    f"{table} was replaced, but its foreign keys could not be re-added and it has none now: {e}"
+                ) from e
+            finally:
+                conn.execute(text("SET foreign_key_checks = 1"))
+    seconds = time.perf_counter() - t0
+
+    return {
+        "table": table,
+        "rows": len(rows),
+        "chunks": chunks,
+        "method": f"shadow_swap/{method or 'insert_values'}",
+        "seconds": round(seconds, 3),
+        "load_seconds": round(load_seconds, 3),
+        "rows_per_sec": round(len(rows) / seconds, 1) if seconds > 0 else None,
+    }
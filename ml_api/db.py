@@ -2,4 +2,8 @@ import os
 from sqlalchemy import create_engine
 
 DB_URL = os.getenv("ML_DATABASE_URL", "mysql+pymysql://root:@127.0.0.1:3306/esports_db?charset=utf8mb4")
-engine = create_engine(DB_URL)
\ No newline at end of file
+
+# LOAD DATA LOCAL INFILE for bulk writes (see bulk_write.py); needs local_infile on the server too.
+BULK_LOAD_DATA = os.getenv("ML_BULK_LOAD_DATA", "0") == "1"
+
+engine = create_engine(DB_URL, connect_args={"local_infile": True} if BULK_LOAD_DATA else {})
\ No newline at end of file
@@ -7,40 +7,118 @@ import pandas as pd
 import joblib
 from sqlalchemy import text
 from sklearn.metrics import mean_absolute_error
-from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
 
 from db import engine
+import model_registry
+from model_registry import MODEL_DIR
+from bulk_write import bulk_upsert
+from read_cache import bump_generation
+from jobs import stage
+from sales_rollup import load_daily_sales
+from storage import DATA_DIR, atomic_dump, load_or_none
+from model_selection import walk_forward_folds, search_candidates, pick_best, make_model
+from tree_export import CompiledTrees, compile_ensemble, compare_compiled, artifact_stats
+from watermark import WatermarkScan, settled_before
 
 
 # ---------------- Helpers ----------------
 def ceil_int(x: float) -> int:
     return int(math.ceil(x)) if x > 0 else 0
 
-def build_daily_sales(df_items: pd.DataFrame) -> pd.DataFrame:
-    df = df_items.copy()
-    df["day"] = pd.to_datetime(df["created_at"]).dt.date
-    daily = (
-        df.groupby(["product_id", "day"], as_index=False)["quantity"]
-        .sum()
-        .rename(columns={"quantity": "qty"})
-    )
-    daily["day"] = pd.to_datetime(daily["day"])
-    return daily
-
 def make_features_v2(history: pd.Series, day: pd.Timestamp) -> dict:
+    """Features for one product: a one-row RollingFeatureState over history."""
     vals = history.values.astype(float)
+    tail = vals[-HIST_WINDOW:]
+    win = np.full((1, HIST_WINDOW), np.nan)
+    win[0, HIST_WINDOW - len(tail):] = tail
+
+    row = RollingFeatureState(win, np.array([len(vals)])).features(day)[0]
+    feats = dict(zip(FEATURE_COLS_V2, row.tolist()))
+    feats["dow"] = int(feats["dow"])
+    feats["days_hist"] = int(feats["days_hist"])
+    return feats
+
+FEATURE_COLS_V2 = ["dow","lag_1","lag_7","lag_14","roll_7","roll_14","roll_30","std_7","zero_rate_30","days_hist"]
+
+def dense_daily_layout(df_daily: pd.DataFrame):
+    """Lay every product's sales out as one contiguous zero-filled daily block
+    (first sale -> last sale), the array form of grp.asfreq("D", fill_value=0.0).
+
+    Returns (product_ids, first_day, starts, lens, vals); product g owns
+    vals[starts[g]:starts[g] + lens[g]].
+    """
+    daily = df_daily[["product_id", "day", "qty"]].sort_values(["product_id", "day"])
+    pids = daily["product_id"].to_numpy()
+    days = pd.to_datetime(daily["day"]).to_numpy().astype("datetime64[D]")
+    qty = daily["qty"].to_numpy(dtype=float)
+
+    first_idx = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]])
+    counts = np.diff(np.r_[first_idx, len(pids)])
+    first_day = days[first_idx]
+    lens = (days[first_idx + counts - 1] - first_day).astype(np.int64) + 1
+    starts = np.r_[0, np.cumsum(lens)[:-1]].astype(np.int64)
+
+    vals = np.zeros(int(lens.sum()), dtype=float)
+    vals[np.repeat(starts, counts) + (days - np.repeat(first_day, counts)).astype(np.int64)] = qty
+    return pids[first_idx], first_day, starts, lens, vals
+
+def build_feature_matrix_v2(df_daily: pd.DataFrame) -> pd.DataFrame:
+    """Vectorized make_features_v2 over every product-day at once.
+
+    Row i of a product is built from history s[:i] of its dense daily series,
+    exactly like the per-row path. Windows come from per-product prefix sums,
+    so cost is linear in product-days.
+    """
+    cols = ["product_id"] + FEATURE_COLS_V2 + ["y", "day"]
+    if df_daily.empty:
+        return pd.DataFrame(columns=cols)
+
+    product_ids, first_day, starts, lens, vals = dense_daily_layout(df_daily)
+    group = np.repeat(np.arange(len(lens)), lens)
+    pos = np.arange(len(vals)) - np.repeat(starts, lens)
+
+    # Exclusive prefix sums restarted per product: p[j] = sum(vals[start:j]).
+    def prefix(a):
+        return pd.Series(a).groupby(group).cumsum().to_numpy() - a
+
+    p_sum = prefix(vals)
+    p_zero = prefix((vals == 0.0).astype(float))
+
+    # Row j predicts vals[j] from the i = pos[j] >= 1 values before it.
+    j = np.flatnonzero(pos >= 1)
+    i = pos[j]
+
+    def window(p, n):
+        w = np.minimum(i, n)
+        return p[j] - p[j - w], w
+
+    def lag(n):
+        return np.where(i >= n, vals[j - np.minimum(i, n)], 0.0)
+
+    def roll(n):
+        s, w = window(p_sum, n)
+        return s / w
+
+    def std(n):
+        # Short window: accumulate in np.std's order (mean first, then squared
+        # deviations oldest -> newest) so results match bit for bit.
+        w = np.minimum(i, n)
+        m = window(p_sum, n)[0] / w
+        acc = np.zeros(len(j))
+        for k in range(n):
+            x = vals[np.maximum(j - w + k, 0)]
+            acc += np.where(k < w, (x - m) ** 2, 0.0)
+        return np.sqrt(acc / w)
 
-    def lag(n): return float(vals[-n]) if len(vals) >= n else 0.0
-    def roll(n): return float(np.mean(vals[-n:])) if len(vals) >= n else float(np.mean(vals)) if len(vals) else 0.0
-    def std(n): return float(np.std(vals[-n:])) if len(vals) >= n else float(np.std(vals)) if len(vals) else 0.0
     def zero_rate(n):
-        if len(vals) == 0:
-            return 1.0
-        window = vals[-n:] if len(vals) >= n else vals
-        return float(np.mean(window == 0.0))
+        z, w = window(p_zero, n)
+        return z / w
 
-    return {
-        "dow": int(day.dayofweek),
+    day = pd.DatetimeIndex(np.repeat(first_day, lens)[j] + i.astype("timedelta64[D]")).astype("datetime64[ns]")
+
+    return pd.DataFrame({
+        "product_id": product_ids[group[j]],
+        "dow": day.dayofweek.astype(int),
         "lag_1": lag(1),
         "lag_7": lag(7),
         "lag_14": lag(14),
@@ -49,24 +127,175 @@ def make_features_v2(history: pd.Series, day: pd.Timestamp) -> dict:
         "roll_30": roll(30),
         "std_7": std(7),
         "zero_rate_30": zero_rate(30),
-        "days_hist": int(len(vals)),
-    }
-
-FEATURE_COLS_V2 = ["dow","lag_1","lag_7","lag_14","roll_7","roll_14","roll_30","std_7","zero_rate_30","days_hist"]
-
+        "days_hist": i.astype(int),
+        "y": vals[j],
+        "day": day,
+    }, columns=cols)
+
+# make_features_v2 never looks further back than this many days.
+HIST_WINDOW = 30
+
+def recent_history_windows(starts: np.ndarray, lens: np.ndarray, vals: np.ndarray) -> np.ndarray:
+    """Last HIST_WINDOW values of every dense block, right aligned and NaN padded."""
+    ends = (starts + lens)[:, None]
+    idx = ends - HIST_WINDOW + np.arange(HIST_WINDOW)
+    valid = idx >= starts[:, None]
+    return np.where(valid, vals[np.maximum(idx, 0)], np.nan)
+
+class RollingFeatureState:
+    """The v2 features of many products, kept up to date one day at a time.
+
+    Each product's last HIST_WINDOW values sit in a ring buffer next to running
+    window sums and a zero count, so push() and features() cost O(1) per
+    product and reuse the same arrays every step. std_7 is recomputed from the
+    last 7 slots in np.std's order, matching the training features bit for bit.
+    """
+
+    def __init__(self, win: np.ndarray, n_hist: np.ndarray):
+        # win: last HIST_WINDOW history values per product (NaN padded on the
+        # left); n_hist: full history length behind it.
+        self.buf = np.nan_to_num(win, nan=0.0)
+        self.n_hist = np.asarray(n_hist, dtype=np.int64).copy()
+        self.head = 0  # slot of the oldest value; the newest is at head - 1
+        self._resync()
+
+        self.X = np.zeros((len(self.n_hist), len(FEATURE_COLS_V2)))
+        self._w = np.zeros(len(self.n_hist))
+        self._tmp = np.zeros(len(self.n_hist))
+        self._acc = np.zeros(len(self.n_hist))
+
+    def _resync(self):
+        # Exact window sums from the buffer. Only valid when head == 0 (buffer
+        # in chronological order); push() calls it on every wrap so rounding in
+        # the running sums never builds up.
+        valid = np.arange(HIST_WINDOW)[::-1] < self.n_hist[:, None]
+        self.sum = {n: self.buf[:, -n:].sum(axis=1) for n in (7, 14, 30)}
+        self.zeros_30 = ((self.buf == 0.0) & valid).sum(axis=1).astype(float)
+
+    def _back(self, n: int) -> np.ndarray:
+        """Value n days back (1 = latest) of every product; 0 where there is none."""
+        return self.buf[:, (self.head - n) % HIST_WINDOW]
+
+    def push(self, y: np.ndarray):
+        """Append one day (y per product) to every history."""
+        for n in (7, 14, 30):
+            full = self.n_hist >= n
+            leaving = self._back(n)
+            self.sum[n] += np.where(full, y - leaving, y)
+            if n == 30:
+                self.zeros_30 += (y == 0.0).astype(float) - (full & (leaving == 0.0))
+        self.buf[:, self.head] = y
+        self.head = (self.head + 1) % HIST_WINDOW
+        self.n_hist += 1
+        if self.head == 0:
+            self._resync()
+
+    def features(self, day: pd.Timestamp) -> np.ndarray:
+        """Feature matrix (FEATURE_COLS_V2 order) for predicting `day`; the
+        returned array is reused by the next call."""
+        X, w, tmp, n_hist = self.X, self._w, self._tmp, self.n_hist
+        X[:, 0] = day.dayofweek
+
+        for col, n in ((1, 1), (2, 7), (3, 14)):
+            np.multiply(self._back(n), n_hist >= n, out=X[:, col])
+
+        for col, n in ((4, 7), (5, 14), (6, 30)):
+            np.minimum(n_hist, n, out=w)
+            X[:, col] = 0.0
+            np.divide(self.sum[n], w, out=X[:, col], where=w > 0)
+
+        # std_7 like np.std over the last min(n_hist, 7) values: mean first,
+        # then squared deviations summed oldest -> newest. Missing older slots
+        # add exact zeros ahead of the real values, so the sums are unchanged.
+        acc = self._acc
+        np.minimum(n_hist, 7, out=w)
+        tmp[:] = 0.0
+        for n in range(7, 0, -1):
+            tmp += np.where(w >= n, self._back(n), 0.0)
+        np.divide(tmp, w, out=tmp, where=w > 0)
+        acc[:] = 0.0
+        for n in range(7, 0, -1):
+            acc += np.where(w >= n, (self._back(n) - tmp) ** 2, 0.0)
+        X[:, 7] = 0.0
+        np.divide(acc, w, out=X[:, 7], where=w > 0)
+        np.sqrt(X[:, 7], out=X[:, 7])
+
+        np.minimum(n_hist, 30, out=w)
+        X[:, 8] = 1.0
+        np.divide(self.zeros_30, w, out=X[:, 8], where=w > 0)
+
+        X[:, 9] = n_hist
+        return X
 
 # ---------------- Model persistence ----------------
-MODEL_DIR = os.getenv("ML_MODEL_DIR", os.path.join(os.path.dirname(__file__), "models"))
-os.makedirs(MODEL_DIR, exist_ok=True)
+FORECAST_KIND = "forecast"
 
+# Pre-registry artifacts, still served until the first versioned model is published.
 FORECAST_MODEL_PATH = os.path.join(MODEL_DIR, "forecast_model.joblib")
 FORECAST_META_PATH  = os.path.join(MODEL_DIR, "forecast_meta.joblib")
 
-def save_forecast(model, meta: dict):
-    joblib.dump(model, FORECAST_MODEL_PATH)
-    joblib.dump(meta, FORECAST_META_PATH)
+def save_forecast(model, meta: dict, X_check=None) -> str:
+    """Publish the model together with its compiled flat-array form
+    (tree_export), which refresh serves when it matches sklearn on X_check."""
+    extra = {}
+    try:
+        compiled = compile_ensemble(model)
+        report = compare_compiled(model, compiled, X_check if X_check is not None else [])
+        if report["matches"]:
+            extra["compiled"] = compiled
+    except Exception as e:
+        # Optional export built on sklearn internals: an upgrade that changes
+        # them must not fail the training run, only leave out the artifact.
+        report = {"matches": False, "error": f"{type(e).__name__}: {e}"}
+
+    version = model_registry.publish(FORECAST_KIND, model, {**meta, "compiled_report": report}, extra)
+    if extra:
+        # Size and load time of both published artifacts, next to the latencies.
+        report["sklearn"].update(artifact_stats(model_registry.artifact_path(FORECAST_KIND, version, "model")))
+        report["compiled"].update(artifact_stats(model_registry.artifact_path(FORECAST_KIND, version, "compiled")))
+        model_registry.update_meta(FORECAST_KIND, version, {"compiled_report": report})
+    return version
+
+# Serve the compiled ensemble when the version has one and its compiled_report
+# says it is the faster predictor for the batch size: much faster to load and
+# for small batches; sklearn's Cython still wins on very large batches.
+FORECAST_COMPILED = os.getenv("ML_FORECAST_COMPILED", "1") == "1"
+
+def compiled_is_faster(report: dict, rows: int) -> bool:
+    """Whether the compiled ensemble predicts a batch of `rows` rows faster than
+    sklearn, going by a line through the single-row and rows_checked batch
+    latencies measured when the version was published."""
+    try:
+        n = max(int(report["rows_checked"]), 2)
+        def cost(latency):
+            row_s = latency["row_ms"] / 1000
+            return row_s + (latency["batch_s"] - row_s) / (n - 1) * (rows - 1)
+        return cost(report["compiled"]) <= cost(report["sklearn"])
+    except (KeyError, TypeError):
+        return True
+
+def load_forecast(compiled: bool = None, rows: int = None):
+    """(model, meta) of the active version. With compiled=True the model is the
+    compiled ensemble when the version has one, so the sklearn pickle is never
+    loaded. By default (ML_FORECAST_COMPILED) the compiled ensemble is used
+    unless predicting batches of `rows` rows is faster with sklearn."""
+    try:
+        active = model_registry.load_active(FORECAST_KIND, ("meta",))
+        if compiled is None:
+            compiled = FORECAST_COMPILED and (
+                rows is None or active is None or compiled_is_faster(active["meta"].get("compiled_report"), rows)
+            )
+        if compiled and active is not None:
+            active = model_registry.load_active(FORECAST_KIND, ("meta", "compiled"))
+            if active is not None and active["compiled"] is not None:
+                return active["compiled"], active["meta"]
+        if active is not None:
+            active = model_registry.load_active(FORECAST_KIND)
+    except Exception:
+        return None, None
+    if active is not None:
+        return active["model"], active["meta"]
 
-def load_forecast():
     if os.path.exists(FORECAST_MODEL_PATH) and os.path.exists(FORECAST_META_PATH):
         try:
             return joblib.load(FORECAST_MODEL_PATH), joblib.load(FORECAST_META_PATH)
@@ -74,6 +303,14 @@ def load_forecast():
             return None, None
     return None, None
 
+def _predictor_for(model, meta: dict, rows: int):
+    """model, or the same version in the form load_forecast() picks for
+    batches of `rows` rows."""
+    chosen, chosen_meta = load_forecast(rows=rows)
+    if chosen is None or (chosen_meta or {}).get("version") != (meta or {}).get("version"):
+        return model
+    return chosen
+
 
 # ---------------- Training + Refresh ----------------
 def build_training_rows_v2(df_daily: pd.DataFrame, eval_holdout_days: int):
@@ -81,115 +318,154 @@ def build_training_rows_v2(df_daily: pd.DataFrame, eval_holdout_days: int):
         return None, None
 
     cutoff = pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=eval_holdout_days)
-    rows = []
+    df = build_feature_matrix_v2(df_daily)
 
-    for _, grp in df_daily.groupby("product_id"):
-        grp = grp.sort_values("day")
-        s = grp.set_index("day")["qty"].asfreq("D", fill_value=0.0)
-        days = s.index.tolist()
-
-        for i in range(1, len(days)):
-            day = days[i]
-            hist = s.iloc[:i]
-            feat = make_features_v2(hist, day)
-            y = float(s.iloc[i])
-            rows.append([feat[c] for c in FEATURE_COLS_V2] + [y, day])
-
-    if len(rows) < 60:
+    if len(df) < 60:
         return None, None
 
-    df = pd.DataFrame(rows, columns=FEATURE_COLS_V2 + ["y", "day"])
-    return df, cutoff
+    return df[FEATURE_COLS_V2 + ["y", "day"]].reset_index(drop=True), cutoff
 
 
-def train_forecast_model(lookback_days: int = 365, eval_holdout_days: int = 30) -> dict:
-    since = datetime.now() - timedelta(days=lookback_days)
+TRAIN_TIME_BUDGET_S = float(os.getenv("ML_TRAIN_TIME_BUDGET_S", "120"))
+TRAIN_WORKERS = int(os.getenv("ML_TRAIN_WORKERS", "0")) or None
 
-    with engine.connect() as conn:
-        items = conn.execute(text("""
-            SELECT oi.product_id, o.created_at, oi.quantity
-            FROM order_item oi
-            INNER JOIN `order` o ON o.id = oi.order_ref_id
-            WHERE o.created_at >= :since
-        """), {"since": since}).fetchall()
+def train_forecast_model(lookback_days: int = 365, eval_holdout_days: int = 30, n_folds: int = 3,
+                         time_budget_s: float = None) -> dict:
+    since = datetime.now() - timedelta(days=lookback_days)
 
-    df_items = pd.DataFrame(items, columns=["product_id","created_at","quantity"])
-    df_daily = build_daily_sales(df_items) if not df_items.empty else pd.DataFrame(columns=["product_id","day","qty"])
+    stage("load_sales")
+    df_daily = load_daily_sales(since)
 
+    stage("features")
     train_df, cutoff = build_training_rows_v2(df_daily, eval_holdout_days)
     if train_df is None:
         return {"trained": False, "message": "Not enough data to train (need more orders)."}
 
-    train_fit = train_df[train_df["day"] < cutoff]
-    eval_df  = train_df[train_df["day"] >= cutoff]
-
-    if len(train_fit) < 60 or len(eval_df) < 10:
+    folds = walk_forward_folds(train_df["day"], cutoff, eval_holdout_days, max(1, n_folds))
+    if not folds:
         return {"trained": False, "message": "Not enough split data for training/eval."}
 
-    X_train = train_fit[FEATURE_COLS_V2]
-    y_train = train_fit["y"].astype(float).values
-    X_eval  = eval_df[FEATURE_COLS_V2]
-    y_eval  = eval_df["y"].astype(float).values
-
-    baseline_pred = eval_df["roll_7"].astype(float).values
-    mae_baseline = float(mean_absolute_error(y_eval, baseline_pred))
+    X = train_df[FEATURE_COLS_V2].to_numpy(dtype=float)
+    y = train_df["y"].astype(float).to_numpy()
+    train_idx, eval_idx = folds[0]
 
-    models = {
-        "HGBR": HistGradientBoostingRegressor(random_state=42),
-        "RF": RandomForestRegressor(n_estimators=300, random_state=42, min_samples_leaf=2, n_jobs=-1),
-    }
+    baseline_pred = train_df["roll_7"].astype(float).to_numpy()[eval_idx]
+    mae_baseline = float(mean_absolute_error(y[eval_idx], baseline_pred))
 
-    best_name = None
-    best_model = None
-    best_mae = None
+    stage("search")
+    budget = TRAIN_TIME_BUDGET_S if time_budget_s is None else time_budget_s
+    candidates = search_candidates(X, y, folds, budget, TRAIN_WORKERS)
+    best = pick_best(candidates)
+    if best is None:
+        return {"trained": False, "message": "No candidate finished within the time budget.", "candidates": candidates}
 
-    for name, mdl in models.items():
-        mdl.fit(X_train, y_train)
-        pred = np.maximum(mdl.predict(X_eval), 0.0)
-        mae = float(mean_absolute_error(y_eval, pred))
-        if best_mae is None or mae < best_mae:
-            best_mae = mae
-            best_name = name
-            best_model = mdl
+    stage("save")
+    # Refit the winner on the holdout fold's training rows: the same model the
+    # search scored as mae_model (fixed random_state).
+    best_model = make_model(best["name"], best["params"], n_jobs=-1)
+    best_model.fit(train_df.iloc[train_idx][FEATURE_COLS_V2], y[train_idx])
+    best_mae = best["mae"]
 
     meta = {
         "trained_at": datetime.now().isoformat(),
-        "model_name": best_name,
+        "model_name": best["name"],
+        "model_params": best["params"],
         "mae_model": best_mae,
         "mae_baseline": mae_baseline,
         "beats_baseline": (best_mae is not None and best_mae < mae_baseline),
         "use_model": (best_mae is not None and best_mae < mae_baseline),
         "feature_set": "v2",
+        "n_folds": len(folds),
+        "time_budget_s": budget,
+        "candidates": candidates,
     }
 
-    save_forecast(best_model, meta)
-    return {"trained": True, **meta}
-
-
-def refresh_forecasts(forecast_days: int = 7, lookback_days: int = 365) -> dict:
+    version = save_forecast(best_model, meta, train_df.iloc[eval_idx][FEATURE_COLS_V2])
+    meta = model_registry.load_artifact(FORECAST_KIND, version, "meta")
+    return {"trained": True, **meta, "version": version}
+
+
+# Incremental refresh: what the last run saw, so the next one only recomputes
+# products whose inputs changed since.
+REFRESH_STATE_PATH = os.path.join(DATA_DIR, "forecast_refresh.joblib")
+
+def load_refresh_state():
+    return load_or_none(REFRESH_STATE_PATH)
+
+def save_refresh_state(state: dict):
+    atomic_dump(REFRESH_STATE_PATH, state)
+
+def _full_refresh_reason(state, today, horizons, lookback_days, meta, full: bool):
+    if full:
+        return "forced"
+    if state is None:
+        return "no_state"
+    # Forecast days (and with them dow and the lookback window) move each day.
+    if state["day"] != today.date().isoformat():
+        return "new_day"
+    if state["horizons"] != horizons or state["lookback_days"] != lookback_days:
+        return "params"
+    if state["model_version"] != (meta or {}).get("version") or state["use_model"] != bool((meta or {}).get("use_model")):
+        return "model"
+    return None
+
+
+def refresh_forecasts(forecast_days: int = 7, lookback_days: int = 365, horizons: list = None,
+                      full: bool = False) -> dict:
+    """Forecast products for each horizon (days) in one recursive pass.
+
+    horizons defaults to [forecast_days]; the forecast is rolled forward once to
+    the longest horizon and each horizon gets its own cumulative total.
+
+    Incremental by default: within a day, only products with new order lines,
+    a stock change, or a category average that moved under them are
+    recomputed and rewritten. full=True (or a new day, new parameters or a new
+    model version) refreshes everything.
+    """
+    horizons = sorted({int(h) for h in (horizons or [forecast_days]) if int(h) > 0})
+    if not horizons:
+        return {"updated": 0, "message": "No valid forecast horizon"}
     since = datetime.now() - timedelta(days=lookback_days)
+    state = None if full else load_refresh_state()
 
+    stage("load_sales")
+    # Products with order lines above the order_item watermark are dirty. Read
+    # them before the rollup syncs, so lines landing in between are counted
+    # again next run rather than missed.
     with engine.connect() as conn:
-        items = conn.execute(text("""
-            SELECT oi.product_id, o.created_at, oi.quantity
+        if state is None:
+            scan = WatermarkScan(conn.execute(text("""
+                SELECT COALESCE(MAX(oi.id), 0)
+                FROM order_item oi
+                INNER JOIN `order` o ON o.id = oi.order_ref_id
+                WHERE o.created_at < :settled_before
+            """), {"settled_before": settled_before()}).scalar())
+        else:
+            scan = WatermarkScan(state["last_item_id"], state.get("recent_item_ids", ()))
+        lines = conn.execute(text("""
+            SELECT oi.id, oi.product_id, o.created_at
             FROM order_item oi
             INNER JOIN `order` o ON o.id = oi.order_ref_id
-            WHERE o.created_at >= :since
-        """), {"since": since}).fetchall()
+            WHERE oi.id > :last_item_id
+        """), {"last_item_id": scan.mark}).fetchall()
+    line_ids, line_products, line_created = zip(*lines) if lines else ((), (), ())
+    new_lines = scan.new_rows(line_ids, line_created)
+    touched_ids = np.unique(np.asarray(line_products, dtype=np.int64)[new_lines]).tolist() if state else []
+    last_item_id, recent_item_ids = scan.result()
 
+    df_daily = load_daily_sales(since)
+
+    with engine.connect() as conn:
         products = conn.execute(text("""
             SELECT id AS product_id, category, stock
             FROM product
         """)).fetchall()
 
-    df_items = pd.DataFrame(items, columns=["product_id","created_at","quantity"])
     df_products = pd.DataFrame(products, columns=["product_id","category","stock"])
 
     if df_products.empty:
         return {"updated": 0, "message": "No products"}
 
-    df_daily = build_daily_sales(df_items) if not df_items.empty else pd.DataFrame(columns=["product_id","day","qty"])
-
     if not df_daily.empty:
         df_daily_with_cat = df_daily.merge(df_products[["product_id","category"]], on="product_id", how="left")
         cat_daily_avg = df_daily_with_cat.groupby("category")["qty"].mean().to_dict()
@@ -198,74 +474,196 @@ def refresh_forecasts(forecast_days: int = 7, lookback_days: int = 365) -> dict:
         cat_daily_avg = {}
         global_daily_avg = 0.0
 
+    stage("predict")
     model, meta = load_forecast()
     use_model = bool(meta.get("use_model")) if meta else False
 
     today = pd.Timestamp(datetime.now().date())
-    rows = []
-
-    for _, pr in df_products.iterrows():
-        pid = int(pr["product_id"])
-        cat = pr["category"] if pd.notna(pr["category"]) else None
-
-        if not df_daily.empty and (df_daily["product_id"] == pid).any():
-            grp = df_daily[df_daily["product_id"] == pid].sort_values("day")
-            s = grp.set_index("day")["qty"].asfreq("D", fill_value=0.0)
-        else:
-            s = pd.Series(dtype=float)
-
-        preds = []
-        hist = s.copy()
-
-        for d in range(1, forecast_days + 1):
-            day = today + pd.Timedelta(days=d)
-            feat = make_features_v2(hist, day)
-            baseline_daily = max(0.0, float(feat["roll_7"]))
-
-            if model is not None and use_model and len(hist) >= 14:
-                Xf = pd.DataFrame([[feat[c] for c in FEATURE_COLS_V2]], columns=FEATURE_COLS_V2)
-                yhat = max(0.0, float(model.predict(Xf)[0]))
-            else:
-                if len(hist) >= 7:
-                    yhat = baseline_daily
-                else:
-                    daily_avg = float(cat_daily_avg.get(cat, global_daily_avg))
-                    yhat = max(0.0, daily_avg)
-
-            preds.append(yhat)
-            hist.loc[day] = yhat
-
-        predicted_qty = float(np.sum(preds))
-        stock = int(pr["stock"]) if pd.notna(pr["stock"]) else 0
-        reorder = ceil_int((predicted_qty + 1) - stock)
-
-        rows.append({
-            "product_id": pid,
-            "forecast_days": forecast_days,
-            "predicted_qty": round(predicted_qty, 2),
-            "recommended_reorder_qty": reorder,
-            "generated_at": datetime.now()
-        })
-
-    upsert = text("""
-        INSERT INTO product_forecast (product_id, forecast_days, predicted_qty, recommended_reorder_qty, generated_at)
-        VALUES (:product_id, :forecast_days, :predicted_qty, :recommended_reorder_qty, :generated_at)
-        ON DUPLICATE KEY UPDATE
-          predicted_qty=VALUES(predicted_qty),
-          recommended_reorder_qty=VALUES(recommended_reorder_qty),
-          generated_at=VALUES(generated_at)
-    """)
+    n_products = len(df_products)
+    product_ids = df_products["product_id"].to_numpy()
+    stock = df_products["stock"].fillna(0).astype(int).to_numpy()
 
+    win = np.full((n_products, HIST_WINDOW), np.nan)
+    n_hist = np.zeros(n_products, dtype=np.int64)
+    if not df_daily.empty:
+        layout_ids, _, starts, lens, vals = dense_daily_layout(df_daily)
+        layout_pos = pd.Index(layout_ids).get_indexer(product_ids)
+        has_sales = layout_pos >= 0
+        win[has_sales] = recent_history_windows(starts, lens, vals)[layout_pos[has_sales]]
+        n_hist[has_sales] = lens[layout_pos[has_sales]]
+
+    full_reason = _full_refresh_reason(state, today, horizons, lookback_days, meta, full)
+    if full_reason:
+        dirty = np.ones(n_products, dtype=bool)
+    else:
+        prev_stock = df_products["product_id"].map(state["stock"]).to_numpy(dtype=float)
+        dirty = np.isin(product_ids, touched_ids) | (prev_stock != stock)  # NaN: new product
+        if touched_ids:
+            # Short histories forecast from their category's (or the global)
+            # average, which moves with any sale in it.
+            cats = df_products["category"]
+            moved = set(cats[df_products["product_id"].isin(touched_ids)].dropna())
+            dirty |= (n_hist < 7) & (cats.isin(moved) | ~cats.isin(list(cat_daily_avg))).to_numpy()
+
+    # One rolling feature state for the products being refreshed: every horizon
+    # step is an O(1) in-place update plus (at most) a single model.predict call.
+    rows_idx = np.flatnonzero(dirty)
+    if model is not None and use_model:
+        model = _predictor_for(model, meta, int((n_hist[rows_idx] >= 14).sum()))
+    fstate = RollingFeatureState(win[rows_idx], n_hist[rows_idx])
+
+    cat_avg = np.maximum(
+        df_products["category"].iloc[rows_idx].map(cat_daily_avg).fillna(global_daily_avg).to_numpy(dtype=float), 0.0
+    )
+    roll_7 = FEATURE_COLS_V2.index("roll_7")
+    yhat = np.zeros(len(rows_idx))
+    predicted = np.zeros(len(rows_idx))
+    totals = {}
+
+    for d in range(1, horizons[-1] + 1):
+        day = today + pd.Timedelta(days=d)
+        X = fstate.features(day)
+        np.maximum(X[:, roll_7], 0.0, out=yhat)
+        np.copyto(yhat, cat_avg, where=fstate.n_hist < 7)
+
+        if model is not None and use_model:
+            use_rows = fstate.n_hist >= 14
+            if use_rows.any():
+                yhat[use_rows] = np.maximum(model.predict(pd.DataFrame(X[use_rows], columns=FEATURE_COLS_V2)), 0.0)
+
+        predicted += yhat
+        fstate.push(yhat)
+        if d in horizons:
+            totals[d] = predicted.copy()
+
+    generated_at = datetime.now()
+    rows = [
+        {
+            "product_id": int(pid),
+            "forecast_days": h,
+            "predicted_qty": round(float(qty), 2),
+            "recommended_reorder_qty": ceil_int((float(qty) + 1) - int(st)),
+            "generated_at": generated_at,
+        }
+        for h in horizons
+        for pid, qty, st in zip(product_ids[rows_idx], totals[h], stock[rows_idx])
+    ]
+
+    stage("write")
     with engine.begin() as conn:
-        for r in rows:
-            conn.execute(upsert, r)
+        write = bulk_upsert(
+            conn, "product_forecast",
+            ["product_id", "forecast_days", "predicted_qty", "recommended_reorder_qty", "generated_at"],
+            rows,
+            update_columns=["predicted_qty", "recommended_reorder_qty", "generated_at"],
+        )
+    bump_generation("product_forecast")
+
+    save_refresh_state({
+        "day": today.date().isoformat(),
+        "generated_at": generated_at.isoformat(),
+        "last_item_id": int(last_item_id),
+        "recent_item_ids": recent_item_ids,
+        "horizons": horizons,
+        "lookback_days": lookback_days,
+        "model_version": meta.get("version") if meta else None,
+        "use_model": use_model,
+        "stock": dict(zip(product_ids.tolist(), stock.tolist())),
+    })
 
     return {
         "updated": len(rows),
+        "products": n_products,
+        "refreshed_products": int(len(rows_idx)),
+        "mode": "full" if full_reason else "incremental",
+        "full_reason": full_reason,
+        "horizons": horizons,
         "used_saved_model": bool(model is not None),
+        "predictor": ("compiled" if isinstance(model, CompiledTrees) else "sklearn") if model is not None else None,
         "model_name": meta.get("model_name") if meta else None,
+        "model_version": meta.get("version") if meta else None,
         "use_model": use_model,
         "mae_model": meta.get("mae_model") if meta else None,
         "mae_baseline": meta.get("mae_baseline") if meta else None,
         "beats_baseline": meta.get("beats_baseline") if meta else None,
-    }
\ No newline at end of file
+        "write": write,
+    }
+
+
+# ---------------- Drift monitoring ----------------
+# A scheduled retrain first scores the active model on the days it has not seen
+# (one-step-ahead, like mae_model) and only trains again when that error drifts.
+DRIFT_THRESHOLD = float(os.getenv("ML_DRIFT_THRESHOLD", "0.2"))      # relative MAE increase
+DRIFT_MIN_ROWS = int(os.getenv("ML_DRIFT_MIN_ROWS", "50"))           # product-days needed to judge
+DRIFT_MAX_AGE_DAYS = int(os.getenv("ML_DRIFT_MAX_AGE_DAYS", "30"))   # retrain regardless after this
+KEEP_EVALUATIONS = 30
+
+def evaluate_forecast_model(lookback_days: int = 365, threshold: float = None) -> dict:
+    """Score the active model against actual sales since its trained_at and
+    compare with the mae_model / mae_baseline measured at training time."""
+    threshold = DRIFT_THRESHOLD if threshold is None else threshold
+    model, meta = load_forecast()
+    now = datetime.now()
+    evaluation = {"evaluated_at": now.isoformat(), "threshold": threshold}
+    if model is None or not meta or not meta.get("trained_at"):
+        return {**evaluation, "status": "no_model", "drifted": True, "reasons": ["no_model"]}
+
+    trained_at = datetime.fromisoformat(meta["trained_at"])
+    age_days = (now - trained_at).days
+    evaluation.update({"version": meta.get("version"), "trained_at": meta["trained_at"], "age_days": age_days})
+
+    # Same lookback as training so days_hist and the rolling windows see the
+    # same history; only days after trained_at are scored.
+    df_daily = load_daily_sales(now - timedelta(days=lookback_days))
+    df = build_feature_matrix_v2(df_daily)
+    df = df[df["day"] > pd.Timestamp(trained_at.date())]
+    evaluation["rows"] = int(len(df))
+
+    reasons = []
+    if age_days >= DRIFT_MAX_AGE_DAYS:
+        reasons.append("max_age")
+
+    if len(df) < DRIFT_MIN_ROWS:
+        status = "drifted" if reasons else "insufficient_data"
+        return {**evaluation, "status": status, "drifted": bool(reasons), "reasons": reasons}
+
+    y = df["y"].astype(float).to_numpy()
+    model = _predictor_for(model, meta, len(df))
+    # Clipped at 0 like the stored mae_model (model_selection) and refresh.
+    mae_model = float(mean_absolute_error(y, np.maximum(model.predict(df[FEATURE_COLS_V2]), 0.0)))
+    mae_baseline = float(mean_absolute_error(y, df["roll_7"].astype(float).to_numpy()))
+    evaluation.update({"mae_model": mae_model, "mae_baseline": mae_baseline})
+
+    if meta.get("mae_model") is not None and mae_model > meta["mae_model"] * (1 + threshold):
+        reasons.append("model_error")
+    if meta.get("mae_baseline") is not None and mae_baseline > meta["mae_baseline"] * (1 + threshold):
+        reasons.append("baseline_error")
+    if meta.get("use_model") and mae_model >= mae_baseline:
+        reasons.append("model_behind_baseline")
+
+    return {**evaluation, "status": "drifted" if reasons else "valid", "drifted": bool(reasons), "reasons": reasons}
+
+def record_evaluation(evaluation: dict) -> bool:
+    """Append an evaluation to the evaluated version's meta. Pre-registry models
+    have no version to write to."""
+    version = evaluation.get("version")
+    if not version:
+        return False
+    meta = model_registry.load_artifact(FORECAST_KIND, version, "meta") or {}
+    history = (meta.get("evaluations") or [])[-(KEEP_EVALUATIONS - 1):] + [evaluation]
+    model_registry.update_meta(FORECAST_KIND, version, {"last_evaluation": evaluation, "evaluations": history})
+    return True
+
+def retrain_forecast_if_drifted(lookback_days: int = 365, eval_holdout_days: int = 30, n_folds: int = 3,
+                                time_budget_s: float = None, threshold: float = None) -> dict:
+    stage("evaluate")
+    evaluation = evaluate_forecast_model(lookback_days, threshold)
+    if evaluation["status"] != "no_model":
+        record_evaluation(evaluation)
+
+    if not evaluation["drifted"]:
+        return {"trained": False, "retrain_needed": False, "evaluation": evaluation,
+                "message": "Active model is still valid."}
+
+    result = train_forecast_model(lookback_days, eval_holdout_days, n_folds, time_budget_s)
+    return {**result, "retrain_needed": True, "evaluation": evaluation}
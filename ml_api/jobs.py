@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import DATA_DIR, atomic_open
+
+
+# Background jobs for the long train/refresh calls. Job records live as JSON files
+# under ML_DATA_DIR/jobs so any uvicorn worker can answer GET /jobs/{id}; a lock
+# file per (kind, params) coalesces duplicate submissions across workers.
+JOB_DIR = os.path.join(DATA_DIR, "jobs")
+os.makedirs(JOB_DIR, exist_ok=True)
+
+JOB_WORKERS = int(os.getenv("ML_JOB_WORKERS", "2"))
+JOB_TTL_S = int(os.getenv("ML_JOB_TTL_S", str(7 * 24 * 3600)))
+ACTIVE_STATES = ("queued", "running")
+
+_kinds = {}
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="ml-job")
+_local = threading.local()
+
+
+def register(kind: str, fn, stages: list):
+    """stages: names the job reports through stage(), in order; drives progress."""
+    _kinds[kind] = (fn, list(stages))
+
+def kinds() -> list:
+    return sorted(_kinds)
+
+
+# ---------------- Records ----------------
+def _job_path(job_id: str) -> str:
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+def _lock_path(kind: str, params: dict) -> str:
+    key = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return os.path.join(JOB_DIR, f"{kind}-{key}.lock")
+
+def _write(job: dict):
+    job["updated_at"] = datetime.now().isoformat()
+    with atomic_open(_job_path(job["id"]), "w") as f:
+        json.dump({k: v for k, v in job.items() if not k.startswith("_")}, f, default=str)
+
+def get_job(job_id: str):
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def list_jobs(limit: int = 20) -> list:
+    files = [f for f in os.listdir(JOB_DIR) if f.endswith(".json")]
+    files.sort(key=lambda f: os.path.getmtime(os.path.join(JOB_DIR, f)), reverse=True)
+    return [j for j in (get_job(f[:-5]) for f in files[:limit]) if j]
+
+def _prune_finished():
+    cutoff = time.time() - JOB_TTL_S
+    for f in os.listdir(JOB_DIR):
+        path = os.path.join(JOB_DIR, f)
+        try:
+            if f.endswith(".json") and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def _is_live(job) -> bool:
+    if not job or job["state"] not in ACTIVE_STATES:
+        return False
+    try:
+        os.kill(job["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# ---------------- Stage reporting ----------------
+def _close_stage(job: dict):
+    name = job.get("stage")
+    if name is None:
+        return
+    job["stages"].append({"name": name, "seconds": round(time.perf_counter() - job.pop("_stage_t0"), 3)})
+    expected = _kinds[job["kind"]][1]
+    if name in expected:
+        job["progress"] = round((expected.index(name) + 1) / len(expected), 3)
+    job["stage"] = None
+
+def stage(name: str):
+    """Close the current job's running stage and start the next one.
+    A no-op when not called from a job thread."""
+    job = getattr(_local, "job", None)
+    if job is None:
+        return
+    _close_stage(job)
+    job["stage"] = name
+    job["_stage_t0"] = time.perf_counter()
+    _write(job)
+
+
+# ---------------- Submit / run ----------------
+def submit(kind: str, params: dict) -> dict:
+    """Queue a job, or return the queued/running job with the same kind and params."""
+    if kind not in _kinds:
+        raise KeyError(kind)
+
+    _prune_finished()
+    lock = _lock_path(kind, params)
+    for _ in range(2):
+        existing = _lock_owner(lock)
+        if _is_live(existing):
+            return {**existing, "coalesced": True}
+        if existing is not None or os.path.exists(lock):
+            # Finished, or orphaned by a dead worker: take the lock over.
+            try:
+                os.unlink(lock)
+            except FileNotFoundError:
+                pass
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "params": params,
+            "state": "queued",
+            "progress": 0.0,
+            "stage": None,
+            "stages": [],
+            "result": None,
+            "error": None,
+            "pid": os.getpid(),
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        _write(job)
+
+        # Publish the lock with its content in one step: link() fails if another
+        # submitter got there first, and then we coalesce onto their job.
+        tmp = f"{lock}.{job['id']}.tmp"
+        with open(tmp, "w") as f:
+            f.write(job["id"])
+        try:
+            os.link(tmp, lock)
+        except FileExistsError:
+            os.unlink(_job_path(job["id"]))
+            continue
+        finally:
+            os.unlink(tmp)
+
+        _executor.submit(_run, job, lock)
+        return job
+
+    raise RuntimeError(f"Could not acquire job lock for {kind}")
+
+def _lock_owner(lock: str):
+    try:
+        with open(lock) as f:
+            return get_job(f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def _release(lock: str, job_id: str):
+    """Remove the lock file if it still names job_id."""
+    try:
+        with open(lock) as f:
+            if f.read().strip() != job_id:
+                return
+        os.unlink(lock)
+    except FileNotFoundError:
+        pass
+
+def _run(job: dict, lock: str):
+    fn, _ = _kinds[job["kind"]]
+    _local.job = job
+    job["state"] = "running"
+    job["started_at"] = datetime.now().isoformat()
+    _write(job)
+    t0 = time.perf_counter()
+    try:
+        job["result"] = fn(**job["params"])
+        job["state"] = "succeeded"
+    except Exception as e:
+        job["state"] = "failed"
+        job["error"] = f"{type(e).__name__}: {e}"
+        job["traceback"] = traceback.format_exc()
+    finally:
+        _local.job = None
+        _close_stage(job)
+        if job["state"] == "succeeded":
+            job["progress"] = 1.0
+        job["seconds"] = round(time.perf_counter() - t0, 3)
+        job["finished_at"] = datetime.now().isoformat()
+        # Release before publishing the final state: until then the record
+        # says running, so no submitter can have taken the lock over.
+        _release(lock, job["id"])
+        _write(job)
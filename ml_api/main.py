@@ -1,28 +1,164 @@
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field
 
-from forecast import train_forecast_model, refresh_forecasts
-from recommendations import refresh_recommendations, get_recommendations_for_product
+from forecast import train_forecast_model, retrain_forecast_if_drifted, evaluate_forecast_model, refresh_forecasts, FORECAST_KIND
+from sales_rollup import sync_daily_sales
+import model_registry
+import jobs
+from recommendations import (refresh_recommendations, get_recommendations_for_product, get_recommendations_for_products,
+                             get_recommendations_from_index, get_cart_recommendations, neighbour_index)
+from read_cache import ReadCache
 from db import engine
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 
-app = FastAPI(title="LevelUp ML API", version="3.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the cart index so the first cart request doesn't pay for the load.
+    # If the DB is not reachable yet, that first request loads it instead.
+    try:
+        neighbour_index()
+    except Exception:
+        pass
+    yield
+
+app = FastAPI(title="LevelUp ML API", version="3.0", lifespan=lifespan)
+
+# Batch lookups: one round trip and one IN (...) query per page render.
+MAX_BATCH_IDS = 500
+
+class ForecastBatchRequest(BaseModel):
+    product_ids: list[int] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+    days: int = 7
+
+class RecommendBatchRequest(BaseModel):
+    product_ids: list[int] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+    k: int = 6
+
+class CartRecommendRequest(BaseModel):
+    product_ids: list[int] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+    exclude: list[int] = Field(default_factory=list, max_length=MAX_BATCH_IDS)
+    k: int = Field(6, ge=1, le=100)
+
+# Long train/refresh calls can run as background jobs (?background=true):
+# the call returns 202 with a job id and GET /jobs/{id} reports progress.
+jobs.register("train_forecast", train_forecast_model, ["load_sales", "features", "search", "save"])
+jobs.register("retrain_forecast", retrain_forecast_if_drifted, ["evaluate", "load_sales", "features", "search", "save"])
+jobs.register("refresh_forecasts", refresh_forecasts, ["load_sales", "predict", "write"])
+jobs.register("refresh_recommendations", refresh_recommendations, ["load_orders", "similarity", "write"])
+
+def _enqueue(kind: str, params: dict):
+    return JSONResponse(status_code=202, content=jobs.submit(kind, params))
+
+# Single-product lookups are read through a per-worker cache that a refresh
+# invalidates; responses carry ETag/Last-Modified from generated_at so clients
+# can revalidate with a 304 instead of re-downloading.
+forecast_cache = ReadCache("product_forecast")
+recommend_cache = ReadCache("product_recommendation")
+
+def _not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _conditional(request: Request, body: dict, tag: str):
+    # generated_at is naive local time; HTTP dates are GMT with second precision.
+    last_modified = datetime.fromisoformat(body["generated_at"]).astimezone(timezone.utc).replace(microsecond=0)
+    etag = f'"{tag}-{last_modified:%Y%m%d%H%M%S}"'
+    headers = {"ETag": etag, "Last-Modified": format_datetime(last_modified, usegmt=True), "Cache-Control": "no-cache"}
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=body, headers=headers)
 
 @app.get("/health")
 def health():
-    return {"ok": True, "time": datetime.now().isoformat()}
+    return {"ok": True, "time": datetime.now().isoformat(),
+            "cache": {"forecast": forecast_cache.stats(), "recommend": recommend_cache.stats()}}
+
+# ---- Job endpoints ----
+@app.get("/jobs")
+def api_list_jobs(limit: int = 20):
+    return {"kinds": jobs.kinds(), "items": jobs.list_jobs(limit)}
+
+@app.get("/jobs/{job_id}")
+def api_get_job(job_id: str):
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return job
 
 # ---- Forecast endpoints ----
 @app.post("/train/forecast")
-def api_train_forecast(lookback_days: int = 365, eval_holdout_days: int = 30):
-    return train_forecast_model(lookback_days, eval_holdout_days)
+def api_train_forecast(lookback_days: int = 365, eval_holdout_days: int = 30, n_folds: int = 3,
+                       time_budget_s: Optional[float] = None, only_if_drifted: bool = False,
+                       background: bool = False):
+    # only_if_drifted: what the nightly scheduler should call; trains only when
+    # the active model's error on recent sales has drifted.
+    params = {"lookback_days": lookback_days, "eval_holdout_days": eval_holdout_days,
+              "n_folds": n_folds, "time_budget_s": time_budget_s}
+    kind, fn = ("retrain_forecast", retrain_forecast_if_drifted) if only_if_drifted else ("train_forecast", train_forecast_model)
+    if background:
+        return _enqueue(kind, params)
+    return fn(**params)
+
+@app.get("/models/forecast")
+def api_forecast_models():
+    return {
+        "active": model_registry.active_version(FORECAST_KIND),
+        "versions": model_registry.list_versions(FORECAST_KIND),
+    }
+
+@app.get("/models/forecast/drift")
+def api_forecast_drift(lookback_days: int = 365, threshold: Optional[float] = None):
+    return evaluate_forecast_model(lookback_days, threshold)
+
+@app.post("/models/forecast/activate")
+def api_activate_forecast_model(version: str):
+    try:
+        model_registry.activate(FORECAST_KIND, version)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"active": version}
 
 @app.post("/refresh/forecasts")
-def api_refresh_forecasts(forecast_days: int = 7, lookback_days: int = 365):
-    return refresh_forecasts(forecast_days, lookback_days)
+def api_refresh_forecasts(forecast_days: int = 7, lookback_days: int = 365, horizons: Optional[str] = None,
+                          full: bool = False, background: bool = False):
+    # horizons: comma separated, e.g. "7,14,30" -> one pass, one row per product per horizon
+    # full: recompute every product instead of only those whose sales or stock changed
+    try:
+        hs = [int(h) for h in horizons.split(",") if h.strip()] if horizons else None
+    except ValueError:
+        raise HTTPException(status_code=422, detail="horizons must be comma separated integers")
+    params = {"forecast_days": forecast_days, "lookback_days": lookback_days, "horizons": hs, "full": full}
+    if background:
+        return _enqueue("refresh_forecasts", params)
+    return refresh_forecasts(**params)
+
+@app.post("/refresh/sales-rollup")
+def api_refresh_sales_rollup(rebuild: bool = False):
+    out = sync_daily_sales(rebuild)
+    out.pop("daily")
+    return out
 
 @app.get("/forecast/{product_id}")
-def api_get_forecast(product_id: int, days: int = 7):
+def api_get_forecast(product_id: int, request: Request, days: int = 7):
+    out = forecast_cache.get((product_id, days), lambda: _load_forecast(product_id, days))
+    if out is None:
+        raise HTTPException(status_code=404, detail="No forecast for this product. Refresh forecasts first.")
+    return _conditional(request, out, f"f{product_id}-{days}")
+
+def _load_forecast(product_id: int, days: int):
     with engine.connect() as conn:
         row = conn.execute(text("""
             SELECT product_id, forecast_days, predicted_qty, recommended_reorder_qty, generated_at
@@ -31,10 +167,26 @@ def api_get_forecast(product_id: int, days: int = 7):
             ORDER BY generated_at DESC
             LIMIT 1
         """), {"pid": product_id, "days": days}).fetchone()
+    return _forecast_out(row) if row else None
 
-    if not row:
-        raise HTTPException(status_code=404, detail="No forecast for this product. Refresh forecasts first.")
+@app.post("/forecast/batch")
+def api_get_forecast_batch(req: ForecastBatchRequest):
+    pids = list(dict.fromkeys(req.product_ids))
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT product_id, forecast_days, predicted_qty, recommended_reorder_qty, generated_at
+            FROM product_forecast
+            WHERE forecast_days = :days AND product_id IN :pids
+        """).bindparams(bindparam("pids", expanding=True)), {"pids": pids, "days": req.days}).fetchall()
 
+    by_pid = {int(r[0]): _forecast_out(r) for r in rows}
+    return {
+        "forecast_days": req.days,
+        "items": [by_pid[p] for p in pids if p in by_pid],
+        "missing": [p for p in pids if p not in by_pid],
+    }
+
+def _forecast_out(row) -> dict:
     return {
         "product_id": int(row[0]),
         "forecast_days": int(row[1]),
@@ -45,12 +197,29 @@ def api_get_forecast(product_id: int, days: int = 7):
 
 # ---- Recommendation endpoints ----
 @app.post("/refresh/recommendations")
-def api_refresh_recommendations(k: int = 6):
-    return refresh_recommendations(k)
+def api_refresh_recommendations(k: int = 6, rebuild: bool = False, background: bool = False):
+    # rebuild: recompute the co-occurrence store from every order instead of only new ones
+    if background:
+        return _enqueue("refresh_recommendations", {"k": k, "rebuild": rebuild})
+    return refresh_recommendations(k, rebuild)
 
 @app.get("/recommend/{product_id}")
-def api_get_recommendations(product_id: int, k: int = 6):
-    out = get_recommendations_for_product(product_id, k)
+def api_get_recommendations(product_id: int, request: Request, k: int = 6):
+    # The mapped index file answers without a query; the cached table lookup
+    # covers the time before the first refresh publishes it.
+    out = get_recommendations_from_index(product_id, k)
+    if out is None:
+        out = recommend_cache.get((product_id, k), lambda: get_recommendations_for_product(product_id, k))
     if not out["items"]:
         raise HTTPException(status_code=404, detail="No recommendations. Refresh recommendations first.")
-    return out
\ No newline at end of file
+    return _conditional(request, out, f"r{product_id}-{k}")
+
+@app.post("/recommend/batch")
+def api_get_recommendations_batch(req: RecommendBatchRequest):
+    return get_recommendations_for_products(list(dict.fromkeys(req.product_ids)), req.k)
+
+@app.post("/recommend/cart")
+def api_get_cart_recommendations(req: CartRecommendRequest):
+    # Served from the in-memory neighbour index: candidates scored by summed
+    # similarity to every cart item, no DB round trip.
+    return get_cart_recommendations(list(dict.fromkeys(req.product_ids)), req.exclude, req.k)
@@ -0,0 +1,129 @@
+import os
+import shutil
+import threading
+from datetime import datetime
+
+import joblib
+
+from storage import atomic_dump, atomic_open, load_or_none
+
+
+# Versioned model store:
+#   <ML_MODEL_DIR>/<kind>/versions/<version>/{model,meta}.joblib
+#   <ML_MODEL_DIR>/<kind>/ACTIVE   -> name of the version being served
+# A version directory is complete before it becomes visible (rename), and the
+# ACTIVE pointer is swapped with os.replace, so readers never see partial files.
+# A published model never changes; only its meta gets monitoring notes added.
+MODEL_DIR = os.getenv("ML_MODEL_DIR", os.path.join(os.path.dirname(__file__), "models"))
+os.makedirs(MODEL_DIR, exist_ok=True)
+
+KEEP_VERSIONS = int(os.getenv("ML_MODEL_KEEP_VERSIONS", "5"))
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _kind_dir(kind: str) -> str:
+    return os.path.join(MODEL_DIR, kind)
+
+def _versions_dir(kind: str) -> str:
+    return os.path.join(_kind_dir(kind), "versions")
+
+def _active_path(kind: str) -> str:
+    return os.path.join(_kind_dir(kind), "ACTIVE")
+
+
+def list_versions(kind: str) -> list:
+    path = _versions_dir(kind)
+    if not os.path.isdir(path):
+        return []
+    return sorted(v for v in os.listdir(path) if not v.startswith("."))
+
+def active_version(kind: str):
+    try:
+        with open(_active_path(kind)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def activate(kind: str, version: str):
+    if version not in list_versions(kind):
+        raise ValueError(f"Unknown {kind} version: {version}")
+    with atomic_open(_active_path(kind), "w") as f:
+        f.write(version)
+
+def publish(kind: str, model, meta: dict, extra: dict = None, activate_now: bool = True) -> str:
+    """Write a new immutable version (model, meta and any extra artifacts) and,
+    by default, make it the active one. Returns the version name."""
+    os.makedirs(_versions_dir(kind), exist_ok=True)
+    version = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    staging = os.path.join(_versions_dir(kind), f".{version}.tmp")
+    os.makedirs(staging)
+
+    meta = {**meta, "version": version}
+    joblib.dump(model, os.path.join(staging, "model.joblib"))
+    joblib.dump(meta, os.path.join(staging, "meta.joblib"))
+    for name, obj in (extra or {}).items():
+        joblib.dump(obj, os.path.join(staging, f"{name}.joblib"))
+    os.rename(staging, os.path.join(_versions_dir(kind), version))
+
+    if activate_now:
+        activate(kind, version)
+    prune(kind)
+    return version
+
+def prune(kind: str, keep: int = KEEP_VERSIONS):
+    if keep <= 0:
+        return
+    active = active_version(kind)
+    for v in [v for v in list_versions(kind) if v != active][:-keep]:
+        shutil.rmtree(os.path.join(_versions_dir(kind), v), ignore_errors=True)
+
+
+def update_meta(kind: str, version: str, updates: dict) -> dict:
+    """Merge updates into a published version's meta (write-then-rename)."""
+    meta = load_artifact(kind, version, "meta")
+    if meta is None:
+        raise ValueError(f"Unknown {kind} version: {version}")
+    meta = {**meta, **updates}
+    atomic_dump(artifact_path(kind, version, "meta"), meta)
+
+    with _cache_lock:
+        cached = _cache.get(kind)
+        if cached is not None and cached["version"] == version and "meta" in cached:
+            _cache[kind] = {**cached, "meta": meta}
+    return meta
+
+
+def artifact_path(kind: str, version: str, name: str) -> str:
+    return os.path.join(_versions_dir(kind), version, f"{name}.joblib")
+
+def load_artifact(kind: str, version: str, name: str):
+    return load_or_none(artifact_path(kind, version, name))
+
+def load_active(kind: str, artifacts=("model", "meta")):
+    """Active version's artifacts as a dict, deserialized once per process per
+    version: later calls only re-read the ACTIVE pointer."""
+    version = active_version(kind)
+    if version is None:
+        return None
+
+    cached = _cache.get(kind)
+    if cached is not None and cached["version"] == version and all(a in cached for a in artifacts):
+        return cached
+
+    with _cache_lock:
+        cached = _cache.get(kind)
+        cached = dict(cached) if cached is not None and cached["version"] == version else {"version": version}
+        for name in artifacts:
+            if name not in cached:
+                cached[name] = load_artifact(kind, version, name)
+        _cache[kind] = cached
+    return cached
+
+def clear_cache(kind: str = None):
+    with _cache_lock:
+        if kind is None:
+            _cache.clear()
+        else:
+            _cache.pop(kind, None)
@@ -0,0 +1,161 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_absolute_error
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+
+
+# ---------------- Candidates ----------------
+# The first entry of each family is the configuration we always trained before,
+# so under a tight budget those are scored first.
+CANDIDATE_GRID = {
+    "HGBR": (HistGradientBoostingRegressor, [
+        {},
+        {"learning_rate": 0.05, "max_iter": 200},
+        {"max_leaf_nodes": 15, "min_samples_leaf": 40},
+    ]),
+    "RF": (RandomForestRegressor, [
+        {"n_estimators": 300, "min_samples_leaf": 2},
+        {"n_estimators": 150, "min_samples_leaf": 5},
+        {"n_estimators": 150, "min_samples_leaf": 2, "max_features": 0.5},
+    ]),
+}
+
+def candidate_list() -> list:
+    out = []
+    for i in range(max(len(grid) for _, grid in CANDIDATE_GRID.values())):
+        for name, (_, grid) in CANDIDATE_GRID.items():
+            if i < len(grid):
+                out.append((name, grid[i]))
+    return out
+
+def make_model(name: str, params: dict, n_jobs: int = 1):
+    cls, _ = CANDIDATE_GRID[name]
+    kwargs = {"random_state": 42, **params}
+    if cls is RandomForestRegressor:
+        kwargs["n_jobs"] = n_jobs
+    return cls(**kwargs)
+
+
+# ---------------- Walk-forward folds ----------------
+def walk_forward_folds(days: pd.Series, cutoff: pd.Timestamp, fold_days: int, n_folds: int,
+                       min_train: int = 60, min_eval: int = 10) -> list:
+    """(train_idx, eval_idx) pairs over one feature matrix, newest first.
+
+    Fold 0 is the usual holdout (day >= cutoff); each older fold moves the
+    split back by fold_days and evaluates on the fold_days after it.
+    """
+    d = days.to_numpy()
+    folds = []
+    for f in range(n_folds):
+        start = cutoff - pd.Timedelta(days=fold_days * f)
+        end = None if f == 0 else start + pd.Timedelta(days=fold_days)
+        train_idx = np.flatnonzero(d < start)
+        eval_mask = d >= start if end is None else (d >= start) & (d < end)
+        eval_idx = np.flatnonzero(eval_mask)
+        if len(train_idx) < min_train or len(eval_idx) < min_eval:
+            break
+        folds.append((train_idx, eval_idx))
+    return folds
+
+
+# ---------------- Worker ----------------
+# Set once per worker process by the pool initializer, so the feature matrix is
+# shipped to each worker once instead of once per task.
+_X = None
+_y = None
+_FOLDS = None
+
+def _init_worker(X, y, folds):
+    global _X, _y, _FOLDS
+    _X, _y, _FOLDS = X, y, folds
+
+def _score_candidate(name: str, params: dict, deadline: float) -> dict:
+    fold_maes = []
+    fit_seconds = 0.0
+    for train_idx, eval_idx in _FOLDS:
+        # Also checked before the first fold: tasks the pool had already
+        # queued can't be cancelled and may only start after the deadline.
+        if time.time() >= deadline:
+            break
+        mdl = make_model(name, params)
+        t0 = time.perf_counter()
+        mdl.fit(_X[train_idx], _y[train_idx])
+        fit_seconds += time.perf_counter() - t0
+        pred = np.maximum(mdl.predict(_X[eval_idx]), 0.0)
+        fold_maes.append(float(mean_absolute_error(_y[eval_idx], pred)))
+
+    result = {
+        "name": name,
+        "params": params,
+        "fit_seconds": round(fit_seconds, 3),
+        "fold_maes": fold_maes,
+        "mae": fold_maes[0] if fold_maes else None,
+        "mean_mae": float(np.mean(fold_maes)) if fold_maes else None,
+        "folds_completed": len(fold_maes),
+    }
+    if not fold_maes:
+        result["skipped"] = "time_budget"
+    return result
+
+
+# ---------------- Search ----------------
+# After the budget, folds already running get this long to finish; workers
+# still busy then are killed and their candidates reported as skipped.
+SEARCH_GRACE_S = float(os.getenv("ML_SEARCH_GRACE_S", "5"))
+
+def _unscored(name: str, params: dict, **why) -> dict:
+    return {"name": name, "params": params, "fit_seconds": 0.0, "fold_maes": [],
+            "mae": None, "mean_mae": None, "folds_completed": 0, **why}
+
+def search_candidates(X: np.ndarray, y: np.ndarray, folds: list, time_budget_s: float,
+                      max_workers: int = None, grace_s: float = None) -> list:
+    """Score every candidate on every fold in a process pool.
+
+    The budget starts before the pool does, so worker start-up counts against
+    it. Once it has elapsed no new fold starts; running folds get grace_s
+    (default ML_SEARCH_GRACE_S) to finish, then their workers are killed.
+    """
+    tasks = candidate_list()
+    max_workers = max_workers or min(len(tasks), os.cpu_count() or 1)
+    grace_s = SEARCH_GRACE_S if grace_s is None else grace_s
+    deadline = time.time() + time_budget_s
+    results = []
+
+    # spawn, not fork: we are usually called from a uvicorn worker thread.
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(X, y, folds))
+    killed = set()
+    try:
+        futures = [pool.submit(_score_candidate, name, params, deadline) for name, params in tasks]
+        wait(futures, timeout=max(0.0, deadline - time.time()))
+        for fut in futures:
+            fut.cancel()
+        _, killed = wait(futures, timeout=max(0.0, deadline + grace_s - time.time()))
+        if killed:
+            # No public API to stop a running task: terminate the workers, which
+            # breaks the pool and fails the futures they were running.
+            for proc in list((pool._processes or {}).values()):
+                proc.terminate()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    for fut, (name, params) in zip(futures, tasks):
+        if fut.cancelled() or fut in killed:
+            results.append(_unscored(name, params, skipped="time_budget"))
+        elif fut.exception() is not None:
+            results.append(_unscored(name, params, error=str(fut.exception())))
+        else:
+            results.append(fut.result())
+    return results
+
+def pick_best(results: list):
+    """Most folds completed first, then lowest mean walk-forward MAE."""
+    scored = [r for r in results if r["folds_completed"] > 0]
+    if not scored:
+        return None
+    return min(scored, key=lambda r: (-r["folds_completed"], r["mean_mae"]))
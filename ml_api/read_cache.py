@@ -0,0 +1,104 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from storage import DATA_DIR, atomic_open
+
+
+# In-process read-through cache for the GET lookups. Entries expire after a TTL
+# and are evicted least-recently-used past a size cap. A refresh bumps its
+# table's generation number in a file under ML_DATA_DIR, so every uvicorn
+# worker drops its entries on the next lookup after the refresh, not at TTL.
+CACHE_TTL_S = float(os.getenv("ML_CACHE_TTL_S", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("ML_CACHE_MAX_ENTRIES", "10000"))
+
+GENERATION_DIR = os.path.join(DATA_DIR, "generations")
+os.makedirs(GENERATION_DIR, exist_ok=True)
+
+
+# ---------------- Generations ----------------
+def _generation_path(name: str) -> str:
+    return os.path.join(GENERATION_DIR, f"{name}.gen")
+
+def bump_generation(name: str) -> int:
+    gen = current_generation(name) + 1
+    with atomic_open(_generation_path(name), "w") as f:
+        f.write(str(gen))
+    return gen
+
+def current_generation(name: str) -> int:
+    try:
+        with open(_generation_path(name)) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+# ---------------- Cache ----------------
+class ReadCache:
+
+    def __init__(self, name: str, max_entries: int = None, ttl_s: float = None):
+        self.name = name
+        self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.ttl_s = CACHE_TTL_S if ttl_s is None else ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._stat = None
+
+    def _check_generation(self):
+        # One stat() per lookup; the file is only re-read when it was replaced.
+        try:
+            st = os.stat(_generation_path(self.name))
+            stat = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            stat = None
+        if stat == self._stat and self._generation is not None:
+            return
+        generation = current_generation(self.name)
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+            self._stat = stat
+
+    def get(self, key, loader):
+        """Cached loader() result for key; None results are cached too, so
+        lookups that miss the table don't hit the DB on every request."""
+        if self.max_entries <= 0 or self.ttl_s <= 0:
+            return loader()
+
+        self._check_generation()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+        with self._lock:
+            # A refresh that landed while loading may have cleared the cache;
+            # don't put a value read before it back.
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl_s, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            "generation": self._generation,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
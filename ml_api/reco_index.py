@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+
+from storage import DATA_DIR, atomic_open
+
+
+# Every product's top-k list in one fixed-width binary file, published next to
+# the product_recommendation table by each refresh. Workers map it with
+# numpy.memmap, so they all share the page-cached file and a lookup is two
+# array reads, no DB query.
+#
+# Layout (little endian, every section 4-byte aligned):
+#   header       INDEX_HEADER
+#   offsets      int32[id_span]    product id -> row, -1 when the id has no row
+#   neighbours   int32[n, k]       recommended product ids, best first, -1 pads
+#   scores       float32[n, k]
+#   generated    int64[n]          row's generated_at, microseconds since epoch
+#   fallback     uint8[n]          1 when the row is the popularity fallback,
+#                                  not real neighbours
+INDEX_PATH = os.path.join(DATA_DIR, "reco_topk.idx")
+INDEX_MAGIC = b"MLRECIDX"
+INDEX_FORMAT = 2
+INDEX_HEADER = np.dtype([
+    ("magic", "S8"), ("format", "<u4"), ("k", "<u4"), ("n", "<u8"), ("id_span", "<u8"), ("pad", "V32"),
+])
+
+
+def write_index(lists: dict, k: int, fallback: set = (), path: str = INDEX_PATH) -> dict:
+    """lists: product id -> (generated_at, [(recommended id, score), ...] best first);
+    fallback: the products whose list is the popularity fallback."""
+    pids = np.array(sorted(lists), dtype=np.int64)
+    n = len(pids)
+    id_span = int(pids[-1]) + 1 if n else 0
+
+    offsets = np.full(id_span, -1, dtype=np.int32)
+    offsets[pids] = np.arange(n, dtype=np.int32)
+    neighbours = np.full((n, k), -1, dtype=np.int32)
+    scores = np.zeros((n, k), dtype=np.float32)
+    generated = np.empty(n, dtype="datetime64[us]")
+    is_fallback = np.isin(pids, np.fromiter(fallback, dtype=np.int64)).astype(np.uint8)
+    for i, pid in enumerate(pids.tolist()):
+        generated_at, recs = lists[pid]
+        generated[i] = generated_at
+        recs = recs[:k]
+        if recs:
+            neighbours[i, :len(recs)] = [r[0] for r in recs]
+            scores[i, :len(recs)] = [r[1] for r in recs]
+
+    header = np.zeros(1, dtype=INDEX_HEADER)
+    header[0] = (INDEX_MAGIC, INDEX_FORMAT, k, n, id_span, b"")
+
+    # Write-then-rename: workers that still map the old file keep reading it.
+    with atomic_open(path) as f:
+        for part in (header, offsets, neighbours, scores, generated.view(np.int64), is_fallback):
+            f.write(part.tobytes())
+    return {"path": path, "products": n, "k": k, "bytes": os.path.getsize(path)}
+
+
+class MappedIndex:
+
+    def __init__(self, path: str = INDEX_PATH):
+        # Every section is mapped from this one handle, so a refresh replacing
+        # path meanwhile can't mix sections of two files.
+        with open(path, "rb") as f:
+            header = np.fromfile(f, dtype=INDEX_HEADER, count=1)
+            if len(header) != 1 or header[0]["magic"] != INDEX_MAGIC or header[0]["format"] != INDEX_FORMAT:
+                raise ValueError(f"Not a recommendation index: {path}")
+            self.path = path
+            self.k = int(header[0]["k"])
+            n, id_span = int(header[0]["n"]), int(header[0]["id_span"])
+
+            pos = INDEX_HEADER.itemsize
+            def section(dtype, shape):
+                nonlocal pos
+                size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                arr = np.memmap(f, dtype=dtype, mode="r", offset=pos, shape=shape) if size else np.empty(shape, dtype)
+                pos += size
+                return arr
+            self.offsets = section(np.int32, (id_span,))
+            self.neighbours = section(np.int32, (n, self.k))
+            self.scores = section(np.float32, (n, self.k))
+            self.generated = section(np.int64, (n,))
+            self.fallback = section(np.uint8, (n,))
+
+    def __len__(self) -> int:
+        return len(self.generated)
+
+    def row(self, product_id: int) -> int:
+        if not 0 <= product_id < len(self.offsets):
+            return -1
+        return int(self.offsets[product_id])
+
+    def lookup(self, product_id: int, k: int):
+        """(generated_at, [(recommended id, score), ...]) or None when the
+        product has no row."""
+        i = self.row(product_id)
+        if i < 0:
+            return None
+        nb = self.neighbours[i, :k].tolist()
+        sc = self.scores[i, :k].tolist()
+        generated_at = np.datetime64(int(self.generated[i]), "us").item()
+        return generated_at, [(p, s) for p, s in zip(nb, sc) if p >= 0]
+
+    def lists(self) -> dict:
+        """Every row in write_index()'s input form."""
+        pids = np.flatnonzero(np.asarray(self.offsets) >= 0)
+        rows = np.asarray(self.offsets)[pids]
+        generated = np.asarray(self.generated)[rows].astype("datetime64[us]").tolist()
+        return {
+            pid: (gen, [(p, s) for p, s in zip(nb, sc) if p >= 0])
+            for pid, gen, nb, sc in zip(pids.tolist(), generated,
+                                        self.neighbours[rows].tolist(), self.scores[rows].tolist())
+        }
+
+
+_mapped = None
+_mapped_stat = None
+
+def mapped_index():
+    """This worker's map of INDEX_PATH, reopened when a refresh replaces the
+    file; None while no index has been published."""
+    global _mapped, _mapped_stat
+    try:
+        st = os.stat(INDEX_PATH)
+    except FileNotFoundError:
+        _mapped = _mapped_stat = None
+        return None
+    stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if stat != _mapped_stat:
+        try:
+            _mapped = MappedIndex(INDEX_PATH)
+        except (OSError, ValueError):
+            _mapped = None
+        _mapped_stat = stat
+    return _mapped
@@ -1,58 +1,306 @@
+import os
+import threading
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import text
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from sqlalchemy import text, bindparam
 
 from db import engine
+from bulk_write import bulk_upsert, replace_table, BULK_CHUNK_SIZE
+from jobs import stage
+from read_cache import bump_generation, current_generation
+from reco_index import write_index, mapped_index
+from similarity import cosine_rows, similarity_top_k
+from storage import DATA_DIR, atomic_dump, load_or_none
+from watermark import WatermarkScan
 
 
-def refresh_recommendations(k: int = 6) -> dict:
-    df = pd.read_sql("""
-        SELECT oi.order_ref_id AS order_id, oi.product_id, oi.quantity
+# ---------------- Co-occurrence store ----------------
+# Item-item co-occurrence C = B^T B of the orders x products basket B, kept with
+# an order-id watermark (see watermark.py): new orders only add their own
+# B_new^T B_new. Cosine is C_ij / sqrt(C_ii * C_jj), so scores and top-k lists
+# only move for products in new orders and the products bought together with
+# them.
+COOC_PATH = os.path.join(DATA_DIR, "reco_cooccurrence.joblib")
+
+def load_cooc_store():
+    return load_or_none(COOC_PATH)
+
+def save_cooc_store(store: dict):
+    atomic_dump(COOC_PATH, store)
+
+def _reindex(mat, old_ids: np.ndarray, new_ids: np.ndarray):
+    """Square matrix over old_ids -> the same matrix over the (sorted, superset) new_ids."""
+    if len(old_ids) == len(new_ids):
+        return mat
+    pos = np.searchsorted(new_ids, old_ids)
+    coo = mat.tocoo()
+    return sparse.csr_matrix((coo.data, (pos[coo.row], pos[coo.col])), shape=(len(new_ids), len(new_ids)))
+
+def merge_orders(store, df: pd.DataFrame) -> dict:
+    """Fold new (order_id, product_id, quantity) lines into the store."""
+    ids = np.union1d(store["product_ids"], df["product_id"].to_numpy(dtype=np.int64)) if store else \
+        np.unique(df["product_id"].to_numpy(dtype=np.int64))
+
+    # Orders x products basket of the new lines as CSR straight from the codes
+    # (repeated lines are summed on conversion), so memory tracks order lines.
+    order_codes, order_index = pd.factorize(df["order_id"])
+    basket = sparse.csr_matrix(
+        (df["quantity"].to_numpy(dtype=float), (order_codes, np.searchsorted(ids, df["product_id"].to_numpy()))),
+        shape=(len(order_index), len(ids)),
+    )
+    cooc = (basket.T @ basket).tocsr()
+    popularity = np.asarray(basket.sum(axis=0)).ravel()
+
+    if store:
+        old_ids = store["product_ids"]
+        cooc = cooc + _reindex(store["cooc"], old_ids, ids)
+        popularity[np.searchsorted(ids, old_ids)] += store["popularity"]
+        if "lists" in store:
+            kth = np.zeros(len(ids))
+            kth[np.searchsorted(ids, old_ids)] = store["kth"]
+            store = {**store, "kth": kth, "lists": _reindex(store["lists"], old_ids, ids)}
+
+    return {
+        **(store or {}),
+        "product_ids": ids,
+        "cooc": cooc,
+        "popularity": popularity,
+    }
+
+def _drop_products(store: dict, keep: np.ndarray) -> dict:
+    """The store restricted to product_ids[keep] (products still in the catalog)."""
+    idx = np.flatnonzero(keep)
+    out = {
+        **store,
+        "product_ids": store["product_ids"][idx],
+        "cooc": store["cooc"][idx][:, idx].tocsr(),
+        "popularity": store["popularity"][idx],
+    }
+    if "lists" in store:
+        out["kth"] = store["kth"][idx]
+        out["lists"] = store["lists"][idx][:, idx].tocsr()
+    return out
+
+def _affected_rows(store: dict, touched_idx: np.ndarray) -> np.ndarray:
+    """Products whose top-k list can change after orders touching touched_idx.
+
+    Touched products get new norms, so their whole rows move. Another product
+    j only sees its scores against touched products move: its list changes if
+    one of them is already in it, or now scores above j's current k-th best.
+    """
+    if not len(touched_idx):
+        return touched_idx
+    touched_sim = cosine_rows(store["cooc"], touched_idx)
+    cand = np.setdiff1d(touched_sim.indices, touched_idx)
+    if not len(cand):
+        return touched_idx
+
+    best_new = touched_sim[:, cand].max(axis=0).toarray().ravel()
+    listed = store["lists"][cand][:, touched_idx].getnnz(axis=1) > 0
+    return np.union1d(touched_idx, cand[listed | (best_new >= store["kth"][cand])])
+
+def _update_lists(store: dict, rows_idx, nb_rows, nb_cols, nb_scores, k: int, full: bool) -> dict:
+    """Keep each product's current neighbour set (sparse membership matrix) and
+    k-th best score, which _affected_rows checks new scores against."""
+    n = len(store["product_ids"])
+    if full or "lists" not in store:
+        kth = np.zeros(n)
+        lists = sparse.csr_matrix((n, n), dtype=bool)
+    else:
+        kth = store["kth"].copy()
+        keep = sparse.diags((~np.isin(np.arange(n), rows_idx)).astype(float))
+        lists = (keep @ store["lists"]).astype(bool).tocsr()
+        lists.eliminate_zeros()
+
+    # Rows with fewer than k neighbours keep kth = 0: any positive score gets in.
+    kth[rows_idx] = 0.0
+    if len(nb_rows):
+        counts = np.bincount(nb_rows, minlength=n)
+        last = np.r_[np.flatnonzero(np.diff(nb_rows)), len(nb_rows) - 1]
+        full_rows = nb_rows[last][counts[nb_rows[last]] >= k]
+        kth[full_rows] = nb_scores[last][counts[nb_rows[last]] >= k]
+        lists = lists + sparse.csr_matrix((np.ones(len(nb_rows), dtype=bool), (nb_rows, nb_cols)), shape=(n, n))
+
+    return {**store, "kth": kth, "lists": lists.tocsr()}
+
+
+# How a full refresh publishes: "swap" loads a shadow table and renames it over
+# product_recommendation, so readers keep the old lists until the new ones are
+# complete; "delete" rewrites the live table in one transaction (needed where
+# RENAME TABLE is unavailable, e.g. the SQLite bench).
+RECO_PUBLISH = os.getenv("ML_RECO_PUBLISH", "swap")
+
+
+def refresh_recommendations(k: int = 6, rebuild: bool = False) -> dict:
+    """Recommendations for every catalog product: top-k cosine neighbours, or
+    the most popular products when there are none.
+
+    Incremental by default: only orders after the store's watermark are read
+    and only the products whose lists can have changed are rewritten.
+    rebuild=True recomputes everything from all orders.
+    """
+    stage("load_orders")
+    store = None if rebuild else load_cooc_store()
+    scan = WatermarkScan(store["last_order_id"], store.get("recent_order_ids", ())) if store else WatermarkScan(0)
+    df = pd.read_sql(text("""
+        SELECT oi.order_ref_id AS order_id, oi.product_id, oi.quantity, o.created_at
         FROM order_item oi
-    """, engine)
+        INNER JOIN `order` o ON o.id = oi.order_ref_id
+        WHERE oi.order_ref_id > :last_order_id
+    """), engine, params={"last_order_id": scan.mark})
+    df = df[scan.new_rows(df["order_id"], df["created_at"])]
+    last_order_id, recent_order_ids = scan.result()
+    all_products = pd.read_sql("SELECT id FROM product", engine)["id"].astype(int).tolist()
 
-    if df.empty:
+    if df.empty and store is None:
         return {"updated_products": 0, "message": "No order_item data"}
 
-    popularity = df.groupby("product_id")["quantity"].sum().sort_values(ascending=False)
-    top_popular = popularity.index.astype(int).tolist()
+    stage("similarity")
+    full = store is None or store.get("k") != k
+    touched = np.unique(df["product_id"].to_numpy(dtype=np.int64))
+    if not df.empty:
+        store = merge_orders(store, df)
 
-    basket = df.pivot_table(index="order_id", columns="product_id", values="quantity", aggfunc="sum", fill_value=0)
-    prod_ids = basket.columns.astype(int).tolist()
+    # Products deleted from the catalog leave the store, so they are never
+    # recommended again (recommended_product_id references product); the
+    # products that listed one get a new list.
+    relisted = np.empty(0, dtype=np.int64)
+    gone = ~np.isin(store["product_ids"], all_products)
+    if gone.any():
+        if "lists" in store:
+            relisted = store["product_ids"][(store["lists"][:, gone].getnnz(axis=1) > 0) & ~gone]
+        store = _drop_products(store, ~gone)
+        touched = touched[np.isin(touched, store["product_ids"])]
+    ids, cooc = store["product_ids"], store["cooc"]
+    prod_ids = ids.tolist()
 
-    sim_df = pd.DataFrame(cosine_similarity(basket.T.values), index=prod_ids, columns=prod_ids)
+    # Most popular first, ties by product id.
+    top_popular = ids[np.lexsort((ids, -store["popularity"]))].tolist()
+    popular_head = top_popular[:k + 1]
 
-    all_products = pd.read_sql("SELECT id FROM product", engine)["id"].astype(int).tolist()
-    now = datetime.now()
+    written = set(store.get("written", ()))
+    fallback = set(store.get("fallback", ()))
+    if full:
+        rows_idx = np.arange(len(ids))
+        refresh = set(all_products)
+    else:
+        rows_idx = np.union1d(_affected_rows(store, np.searchsorted(ids, touched)), np.searchsorted(ids, relisted))
+        refresh = set(ids[rows_idx].tolist()) | (set(all_products) - written)
+        if popular_head != store.get("popular_head"):
+            refresh |= fallback
 
+    nb_rows, nb_cols, nb_scores = similarity_top_k(cooc, rows_idx, k)
+    neighbours = {}
+    for r, c, sc in zip(nb_rows.tolist(), nb_cols.tolist(), nb_scores.tolist()):
+        neighbours.setdefault(prod_ids[r], []).append((prod_ids[c], sc))
+    store = _update_lists(store, rows_idx, nb_rows, nb_cols, nb_scores, k, full)
+
+    now = datetime.now()
+    catalog = set(all_products)
     rows = []
     for pid in all_products:
-        if pid in sim_df.index:
-            scores = sim_df.loc[pid].copy()
-            scores.loc[pid] = -1
-            top = scores.sort_values(ascending=False).head(k)
-            recs = [(int(rid), float(sc)) for rid, sc in top.items() if float(sc) > 0]
-            if not recs:
-                recs = [(int(p), 0.1) for p in top_popular if int(p) != pid][:k]
+        if pid not in refresh:
+            continue
+        recs = neighbours.get(pid)
+        if recs:
+            fallback.discard(pid)
         else:
-            recs = [(int(p), 0.1) for p in top_popular if int(p) != pid][:k]
-
+            # Popularity fallback: k most popular products other than itself.
+            recs = [(p, 0.1) for p in popular_head if p != pid][:k]
+            fallback.add(pid)
         for rec_pid, score in recs:
-            if rec_pid == pid:
-                continue
-            rows.append({"p": pid, "r": rec_pid, "s": score, "g": now})
+            rows.append({"product_id": pid, "recommended_product_id": rec_pid, "score": score, "generated_at": now})
+
+    stage("write")
+    columns = ["product_id", "recommended_product_id", "score", "generated_at"]
+    stale = sorted((refresh & catalog) | (written - catalog))
+    if full and RECO_PUBLISH == "swap":
+        # Raises before the swap on any load error; the live table and the
+        # store on disk are then both left as they were.
+        write = replace_table(engine, "product_recommendation", columns, rows)
+    else:
+        with engine.begin() as conn:
+            if full:
+                conn.execute(text("DELETE FROM product_recommendation"))
+            else:
+                for lo in range(0, len(stale), BULK_CHUNK_SIZE):
+                    conn.execute(text("DELETE FROM product_recommendation WHERE product_id IN :pids")
+                                 .bindparams(bindparam("pids", expanding=True)), {"pids": stale[lo:lo + BULK_CHUNK_SIZE]})
+            write = bulk_upsert(conn, "product_recommendation", columns, rows, update_columns=["score", "generated_at"])
+    fresh = {}
+    for r in rows:
+        fresh.setdefault(r["product_id"], (now, []))[1].append((r["recommended_product_id"], r["score"]))
+    index = _publish_index(fresh, k, full, catalog, fallback & catalog)
+    bump_generation("product_recommendation")
+
+    save_cooc_store({
+        **store,
+        "k": k,
+        "last_order_id": last_order_id,
+        "recent_order_ids": recent_order_ids,
+        "popular_head": popular_head,
+        "written": sorted(catalog),
+        "fallback": sorted(fallback & catalog),
+        "updated_at": now.isoformat(),
+    })
 
-    with engine.begin() as conn:
-        conn.execute(text("DELETE FROM product_recommendation"))
-        conn.execute(text("""
-            INSERT INTO product_recommendation (product_id, recommended_product_id, score, generated_at)
-            VALUES (:p,:r,:s,:g)
-            ON DUPLICATE KEY UPDATE score=VALUES(score), generated_at=VALUES(generated_at)
-        """), rows)
+    return {
+        "updated_products": len(refresh & catalog),
+        "products": len(catalog),
+        "mode": "full" if full else "incremental",
+        "new_order_lines": int(len(df)),
+        "last_order_id": last_order_id,
+        "top_k": k,
+        "write": write,
+        "index": index,
+    }
 
-    return {"updated_products": len(all_products), "top_k": k}
+
+def _publish_index(fresh: dict, k: int, full: bool, catalog: set, fallback: set) -> dict:
+    """Write the top-k index file. fresh holds the refreshed products' lists;
+    on an incremental run every other product keeps its published list (read
+    back from the table when there is no usable index file)."""
+    lists = {}
+    if not full:
+        published = mapped_index()
+        lists = published.lists() if published is not None and published.k == k else _table_lists()
+        lists = {pid: v for pid, v in lists.items() if pid in catalog}
+    lists.update(fresh)
+    return write_index(lists, k, fallback)
+
+def _table_lists() -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT product_id, recommended_product_id, score, generated_at
+            FROM product_recommendation
+            ORDER BY product_id, score DESC, recommended_product_id
+        """)).fetchall()
+    lists = {}
+    for pid, rec_pid, score, gen in rows:
+        gen = gen if isinstance(gen, datetime) else datetime.fromisoformat(str(gen))
+        lists.setdefault(int(pid), (gen, []))[1].append((int(rec_pid), float(score)))
+    return lists
+
+
+def get_recommendations_from_index(product_id: int, k: int = 6):
+    """get_recommendations_for_product() answered from the mapped index file;
+    None when there is no index or it holds fewer than k per product."""
+    index = mapped_index()
+    if index is None or k > index.k:
+        return None
+    found = index.lookup(product_id, k)
+    if found is None:
+        return {"product_id": product_id, "k": k, "items": []}
+    generated_at, recs = found
+    return {
+        "product_id": product_id,
+        "k": k,
+        "generated_at": str(generated_at),
+        "items": [{"product_id": p, "score": round(s, 6)} for p, s in recs],
+    }
 
 
 def get_recommendations_for_product(product_id: int, k: int = 6) -> dict:
@@ -73,4 +321,133 @@ def get_recommendations_for_product(product_id: int, k: int = 6) -> dict:
         "k": k,
         "generated_at": str(rows[0][2]),
         "items": [{"product_id": int(r[0]), "score": float(r[1])} for r in rows],
-    }
\ No newline at end of file
+    }
+
+
+def get_recommendations_for_products(product_ids: list, k: int = 6) -> dict:
+    if not product_ids:
+        return {"k": k, "generated_at": None, "items": {}}
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT product_id, recommended_product_id, score, generated_at
+            FROM product_recommendation
+            WHERE product_id IN :pids
+            ORDER BY product_id, score DESC
+        """).bindparams(bindparam("pids", expanding=True)), {"pids": list(product_ids)}).fetchall()
+
+    items = {int(pid): [] for pid in product_ids}
+    generated_at = None
+    for pid, rec_pid, score, gen in rows:
+        recs = items[int(pid)]
+        if len(recs) < k:
+            recs.append({"product_id": int(rec_pid), "score": float(score)})
+        generated_at = generated_at or str(gen)
+
+    return {"k": k, "generated_at": generated_at, "items": {str(pid): recs for pid, recs in items.items()}}
+
+# ---------------- In-memory neighbour index ----------------
+# Every product's top-k neighbours in flat arrays: the neighbours of
+# product_ids[i] are neighbours[offsets[i]:offsets[i + 1]], best first. Built
+# from the published index file (reco_index) without its popularity-fallback
+# lists, whose placeholder scores would otherwise add up with real
+# similarities. Cart scoring reads only this, never the DB. Each worker loads
+# it once and swaps in a fresh copy in the background after a refresh bumps
+# the generation.
+class NeighbourIndex:
+
+    def __init__(self, product_ids, offsets, neighbours, scores, generated_at, generation: int):
+        self.product_ids = product_ids
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.scores = scores
+        self.generated_at = generated_at
+        self.generation = generation
+        self._row = {pid: i for i, pid in enumerate(product_ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def __contains__(self, product_id: int) -> bool:
+        return product_id in self._row
+
+    def neighbours_of(self, product_id: int):
+        i = self._row.get(product_id)
+        if i is None:
+            return [], []
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.neighbours[lo:hi].tolist(), self.scores[lo:hi].tolist()
+
+    def score_cart(self, product_ids: list, exclude=(), k: int = 6) -> list:
+        """Candidates ranked by their summed similarity to the cart items; the
+        cart itself and exclude are never recommended. Ties by product id."""
+        skip = set(product_ids) | set(exclude)
+        totals = {}
+        for pid in product_ids:
+            for rec_pid, score in zip(*self.neighbours_of(pid)):
+                if rec_pid not in skip:
+                    totals[rec_pid] = totals.get(rec_pid, 0.0) + score
+        return sorted(totals.items(), key=lambda t: (-t[1], t[0]))[:k]
+
+
+def load_neighbour_index() -> NeighbourIndex:
+    """Empty until the first refresh publishes the index file."""
+    generation = current_generation("product_recommendation")
+    mapped = mapped_index()
+    if mapped is None or not len(mapped):
+        empty = np.empty(0, dtype=np.int64)
+        return NeighbourIndex(empty, np.zeros(1, dtype=np.int64), empty, np.empty(0, dtype=np.float32), None, generation)
+
+    all_offsets = np.asarray(mapped.offsets)
+    product_ids = np.flatnonzero(all_offsets >= 0)
+    rows = all_offsets[product_ids]
+    neighbours = np.asarray(mapped.neighbours)[rows]
+    scores = np.asarray(mapped.scores)[rows]
+    # Fallback products stay in the index (they are known), with no neighbours.
+    valid = (neighbours >= 0) & (np.asarray(mapped.fallback)[rows] == 0)[:, None]
+    generated = np.asarray(mapped.generated).max().astype("datetime64[us]").item()
+    return NeighbourIndex(
+        product_ids.astype(np.int64),
+        np.concatenate([[0], np.cumsum(valid.sum(axis=1))]).astype(np.int64),
+        neighbours[valid].astype(np.int64),
+        scores[valid],
+        str(generated),
+        generation,
+    )
+
+_index = None
+_index_lock = threading.Lock()
+_index_reloading = False
+
+def _reload_index():
+    global _index, _index_reloading
+    try:
+        _index = load_neighbour_index()
+    finally:
+        _index_reloading = False
+
+def neighbour_index() -> NeighbourIndex:
+    """The current worker's index. The first call loads it; after a refresh the
+    old index keeps serving until the new one is loaded."""
+    global _index, _index_reloading
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_neighbour_index()
+        return _index
+    if _index.generation != current_generation("product_recommendation"):
+        with _index_lock:
+            if not _index_reloading:
+                _index_reloading = True
+                threading.Thread(target=_reload_index, name="ml-reco-index", daemon=True).start()
+    return _index
+
+
+def get_cart_recommendations(product_ids: list, exclude: list = (), k: int = 6) -> dict:
+    index = neighbour_index()
+    return {
+        "k": k,
+        "generated_at": index.generated_at,
+        "items": [{"product_id": pid, "score": round(score, 6)} for pid, score in index.score_cart(product_ids, exclude, k)],
+        "unknown": [pid for pid in product_ids if pid not in index],
+    }
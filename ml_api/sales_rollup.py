@@ -0,0 +1,121 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from db import engine
+from storage import DATA_DIR, atomic_dump, load_or_none
+from watermark import WatermarkScan
+
+
+# Per-product daily sales, persisted locally with a high-water mark on order_item.id
+# so each run only scans order lines added since the previous one (plus the
+# recent margin watermark.py re-reads, in case of out-of-order commits).
+DAILY_SALES_PATH = os.path.join(DATA_DIR, "daily_sales.joblib")
+
+DAILY_COLS = ["product_id", "day", "qty"]
+# Compact dtypes for both the ingested chunks and the stored rollup.
+DAILY_DTYPES = {"product_id": "int32", "day": "datetime64[s]", "qty": "float32"}
+
+# Order lines fetched per round trip from a server-side cursor; peak ingestion
+# memory is bounded by this, not by the number of new orders.
+INGEST_CHUNK_ROWS = int(os.getenv("ML_INGEST_CHUNK_ROWS", "50000"))
+
+
+def build_daily_sales(df_items: pd.DataFrame) -> pd.DataFrame:
+    day = pd.to_datetime(df_items["created_at"]).dt.normalize().rename("day")
+    daily = (
+        df_items["quantity"]
+        .groupby([df_items["product_id"], day])
+        .sum()
+        .rename("qty")
+        .reset_index()
+    )
+    return daily
+
+def empty_daily() -> pd.DataFrame:
+    return pd.DataFrame({c: pd.Series(dtype=t) for c, t in DAILY_DTYPES.items()})
+
+def merge_daily(frames: list) -> pd.DataFrame:
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return empty_daily()
+    merged = frames[0] if len(frames) == 1 else (
+        pd.concat(frames, ignore_index=True).groupby(["product_id", "day"], as_index=False)["qty"].sum()
+    )
+    return merged.astype(DAILY_DTYPES)
+
+def _chunk_daily(rows: list, scan: WatermarkScan):
+    """One fetched chunk of (id, product_id, created_at, quantity) rows ->
+    (daily sales of the lines not counted by an earlier sync, their number)."""
+    ids, pids, created, qty = zip(*rows)
+    created = np.asarray(created, dtype="datetime64[s]")
+    new = scan.new_rows(ids, created)
+    chunk = pd.DataFrame({
+        "product_id": np.asarray(pids, dtype=np.int32)[new],
+        "created_at": pd.to_datetime(created[new]),
+        "quantity": np.asarray(qty, dtype=np.float32)[new],
+    })
+    return build_daily_sales(chunk), int(new.sum())
+
+
+def load_rollup():
+    state = load_or_none(DAILY_SALES_PATH)
+    if state is None:
+        return empty_daily(), 0, ()
+    return state["daily"].astype(DAILY_DTYPES), int(state["last_item_id"]), state.get("recent_item_ids", ())
+
+def save_rollup(daily: pd.DataFrame, last_item_id: int, recent_item_ids=()):
+    atomic_dump(DAILY_SALES_PATH, {
+        "daily": daily,
+        "last_item_id": last_item_id,
+        "recent_item_ids": np.asarray(recent_item_ids, dtype=np.int64),
+        "updated_at": datetime.now().isoformat(),
+    })
+
+
+def sync_daily_sales(rebuild: bool = False) -> dict:
+    daily, last_item_id, recent = (empty_daily(), 0, ()) if rebuild else load_rollup()
+    scan = WatermarkScan(last_item_id, recent)
+
+    # Stream new lines through a server-side cursor and fold each chunk into
+    # daily sales as it arrives. Pending chunk aggregates are compacted as they
+    # pile up, so memory tracks product-days, not order lines.
+    pending = [daily]
+    pending_rows = len(daily)
+    new_items = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text("""
+            SELECT oi.id, oi.product_id, o.created_at, oi.quantity
+            FROM order_item oi
+            INNER JOIN `order` o ON o.id = oi.order_ref_id
+            WHERE oi.id > :last_item_id
+        """), {"last_item_id": last_item_id})
+
+        for rows in result.partitions(INGEST_CHUNK_ROWS):
+            chunk, chunk_items = _chunk_daily(rows, scan)
+            new_items += chunk_items
+            pending.append(chunk)
+            pending_rows += len(chunk)
+            if pending_rows > 2 * (len(pending[0]) + INGEST_CHUNK_ROWS):
+                pending = [merge_daily(pending)]
+                pending_rows = len(pending[0])
+
+    settled_id, recent = scan.result()
+    if not new_items and settled_id == last_item_id:
+        return {"new_items": 0, "last_item_id": last_item_id, "rows": len(daily), "daily": daily}
+
+    # New lines can land on days already in the rollup: merge by summing.
+    last_item_id = settled_id
+    daily = merge_daily(pending)
+    save_rollup(daily, last_item_id, recent)
+    return {"new_items": new_items, "last_item_id": last_item_id, "rows": len(daily), "daily": daily}
+
+
+def load_daily_sales(since: datetime) -> pd.DataFrame:
+    daily = sync_daily_sales()["daily"]
+    if daily.empty:
+        return empty_daily()
+    return daily[daily["day"] >= pd.Timestamp(since.date())].reset_index(drop=True)
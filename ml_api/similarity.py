@@ -0,0 +1,113 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+
+# Item-item cosine similarity and top-k selection, block by block: at most one
+# dense block of similarity rows (ML_RECO_BLOCK_MB) exists at a time per
+# process, never the full products x products matrix.
+BLOCK_MB = float(os.getenv("ML_RECO_BLOCK_MB", "64"))
+SIM_WORKERS = int(os.getenv("ML_RECO_WORKERS", "0"))
+
+
+# Working bytes per dense cell while a block is scored: the float64 block, its
+# partitioned copy, an int32 tie rank and a few boolean masks.
+BYTES_PER_CELL = 24
+
+def block_rows(n_cols: int) -> int:
+    return max(1, int(BLOCK_MB * 2**20 // (BYTES_PER_CELL * n_cols)))
+
+
+def top_k_neighbours(sim, k: int, self_cols=None):
+    """k best positive-scoring neighbours of every product (row) of a
+    similarity matrix, itself excluded, best first; ties go to the lower
+    column. Returns (row, col, score) arrays ordered by row.
+
+    self_cols: column of each row's own product (default: the diagonal of a
+    square matrix). Uses partial selection (np.partition) per block of rows
+    instead of a full sort of every row.
+    """
+    n_rows, n = sim.shape
+    self_cols = np.arange(n_rows) if self_cols is None else np.asarray(self_cols)
+    k = min(k, n - 1)
+    if k <= 0 or n_rows == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+    step = block_rows(n)
+    out_r, out_c, out_s = [], [], []
+    for lo in range(0, n_rows, step):
+        hi = min(lo + step, n_rows)
+        block = sim[lo:hi].toarray() if sparse.issparse(sim) else np.array(sim[lo:hi], dtype=float)
+        block[np.arange(hi - lo), self_cols[lo:hi]] = -1.0
+
+        # Everything above each row's k-th best score is in; ties at the k-th
+        # score fill the remaining places in column order.
+        kth = np.partition(block, n - k, axis=1)[:, n - k:n - k + 1]
+        above = block > kth
+        tie = block == kth
+        take = above | (tie & (np.cumsum(tie, axis=1, dtype=np.int32) <= k - above.sum(axis=1, keepdims=True)))
+        take &= block > 0
+
+        r, c = np.nonzero(take)
+        sc = block[r, c]
+        order = np.lexsort((c, -sc, r))
+        out_r.append(r[order] + lo)
+        out_c.append(c[order])
+        out_s.append(sc[order])
+
+    return np.concatenate(out_r), np.concatenate(out_c), np.concatenate(out_s)
+
+
+def inverse_norms(cooc) -> np.ndarray:
+    norms = np.sqrt(cooc.diagonal())
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+def cosine_rows(cooc, rows: np.ndarray, inv: np.ndarray = None):
+    """Cosine similarity rows (sparse) of the given products from the
+    co-occurrence matrix: C_ij / sqrt(C_ii * C_jj)."""
+    inv = inverse_norms(cooc) if inv is None else inv
+    return (sparse.diags(inv[rows]) @ cooc[rows] @ sparse.diags(inv)).tocsr()
+
+
+# ---------------- Blocked top-k ----------------
+# Set once per worker process by the pool initializer, so the co-occurrence
+# matrix is shipped to each worker once instead of once per block.
+_COOC = None
+_INV = None
+
+def _init_worker(cooc, inv):
+    global _COOC, _INV
+    _COOC, _INV = cooc, inv
+
+def _top_k_block(rows: np.ndarray, k: int):
+    r, c, sc = top_k_neighbours(cosine_rows(_COOC, rows, _INV), k, rows)
+    return rows[r], c, sc
+
+def similarity_top_k(cooc, rows_idx: np.ndarray, k: int, workers: int = None):
+    """top_k_neighbours of the products rows_idx, scoring one block of cosine
+    rows at a time and keeping only each block's top-k. Blocks run in
+    `workers` processes when > 1 (default ML_RECO_WORKERS).
+
+    Returns (row, col, score) with row as a product index, ordered like rows_idx.
+    """
+    workers = SIM_WORKERS if workers is None else workers
+    step = block_rows(cooc.shape[1])
+    blocks = [rows_idx[lo:lo + step] for lo in range(0, len(rows_idx), step)]
+    if not blocks:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+    inv = inverse_norms(cooc)
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(cooc, inv)) as pool:
+            parts = list(pool.map(_top_k_block, blocks, [k] * len(blocks)))
+    else:
+        parts = []
+        for rows in blocks:
+            r, c, sc = top_k_neighbours(cosine_rows(cooc, rows, inv), k, rows)
+            parts.append((rows[r], c, sc))
+
+    return tuple(np.concatenate([p[i] for p in parts]) for i in range(3))
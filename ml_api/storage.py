@@ -0,0 +1,38 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import joblib
+
+
+# Local state (rollups, stores, indexes, job records) lives under ML_DATA_DIR.
+# Files are replaced whole: written to a temp file next to the target, named per
+# process and thread so concurrent writers never share one, then renamed over
+# it, so a reader sees the old file or the new one, never a partial one.
+DATA_DIR = os.getenv("ML_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+os.makedirs(DATA_DIR, exist_ok=True)
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "wb"):
+    """open(path, mode) for writing; path is only replaced once the block
+    completes without error."""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+def atomic_dump(path: str, obj):
+    with atomic_open(path) as f:
+        joblib.dump(obj, f)
+
+def load_or_none(path: str):
+    """joblib.load(path), or None when the file is missing or unreadable."""
+    try:
+        return joblib.load(path)
+    except Exception:
+        return None
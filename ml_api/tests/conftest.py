@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# ml_api modules import each other flat (run from the ml_api directory).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules read their paths and db.engine's URL at import: point them at a
+# scratch SQLite database and data/model dirs before any test imports them.
+_workdir = tempfile.mkdtemp(prefix="ml_api_tests_")
+os.environ["ML_DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'shop.sqlite')}"
+os.environ["ML_DATA_DIR"] = os.path.join(_workdir, "data")
+os.environ["ML_MODEL_DIR"] = os.path.join(_workdir, "models")
+# SQLite has no RENAME TABLE swap: rebuild recommendations in place.
+os.environ["ML_RECO_PUBLISH"] = "delete"
@@ -0,0 +1,68 @@
+"""Incremental recommendation refreshes against a synthetic SQLite shop.
+
+    cd ml_api && python -m pytest tests
+"""
+import os
+
+import pytest
+from sqlalchemy import text
+
+import db
+import recommendations
+import reco_index
+from bench_forecast import generate_shop, mysql_to_sqlite
+
+mysql_to_sqlite(db.engine)
+
+
+@pytest.fixture
+def shop():
+    db.engine.dispose()
+    path = db.engine.url.database
+    for f in (path, recommendations.COOC_PATH, reco_index.INDEX_PATH):
+        if os.path.exists(f):
+            os.remove(f)
+    generate_shop(path, n_products=40, days=30, orders_per_day=20)
+    yield db.engine
+    db.engine.dispose()
+
+
+def _table(engine) -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT product_id, recommended_product_id, score FROM product_recommendation"
+        )).fetchall()
+    return {(int(p), int(r)): round(float(s), 9) for p, r, s in rows}
+
+
+def _index() -> dict:
+    return {pid: [(p, round(s, 6)) for p, s in recs]
+            for pid, (_, recs) in reco_index.MappedIndex(reco_index.INDEX_PATH).lists().items()}
+
+
+def test_deleted_product_leaves_recommendations(shop):
+    recommendations.refresh_recommendations(k=4)
+    listed = {}
+    for pid, rec in _table(shop):
+        listed[rec] = listed.get(rec, 0) + 1
+    # The most listed product: a neighbour of many and in the popular head.
+    victim = max(listed, key=listed.get)
+
+    # order_item.product_id is ON DELETE RESTRICT: a product only leaves the
+    # catalog once its order lines are gone.
+    with shop.begin() as conn:
+        conn.execute(text("DELETE FROM order_item WHERE product_id = :p"), {"p": victim})
+        conn.execute(text("DELETE FROM product WHERE id = :p"), {"p": victim})
+        conn.execute(text("DELETE FROM product_recommendation WHERE product_id = :p"), {"p": victim})
+
+    result = recommendations.refresh_recommendations(k=4)
+    assert result["mode"] == "incremental"
+    incremental, incremental_index = _table(shop), _index()
+    assert all(victim not in pair for pair in incremental)
+    assert victim not in incremental_index
+    assert all(p != victim for recs in incremental_index.values() for p, _ in recs)
+    assert victim not in recommendations.load_cooc_store()["product_ids"]
+
+    recommendations.refresh_recommendations(k=4, rebuild=True)
+    assert incremental == _table(shop)
+    assert incremental_index == _index()
@@ -0,0 +1,58 @@
+"""Compiled ensembles must predict like the sklearn models they came from.
+
+    cd ml_api && python -m pytest tests
+"""
+import numpy as np
+import pytest
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
+
+from tree_export import COMPILE_TOLERANCE, CompiledTrees, compare_compiled, compile_ensemble
+
+
+def _data(n=400, n_features=10, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(2.0, (n, n_features)).astype(float) * rng.random((n, n_features))
+    y = X[:, 1] * 0.5 + X[:, 4] + rng.random(n)
+    return X, y
+
+
+@pytest.mark.parametrize("model", [
+    RandomForestRegressor(n_estimators=8, max_depth=6, random_state=0),
+    HistGradientBoostingRegressor(max_iter=20, max_leaf_nodes=15, random_state=0),
+])
+def test_compiled_matches_sklearn(model):
+    X, y = _data()
+    model.fit(X, y)
+    compiled = compile_ensemble(model)
+
+    assert isinstance(compiled, CompiledTrees)
+    X_check, _ = _data(seed=1)
+    X_check[::7, 3] = np.nan  # missing values take the learned direction
+    assert np.max(np.abs(model.predict(X_check) - compiled.predict(X_check))) <= COMPILE_TOLERANCE
+    assert compiled.predict(X_check[:1]).shape == (1,)
+
+    report = compare_compiled(model, compiled, X_check, repeats=1)
+    assert report["matches"] and report["rows_checked"] == len(X_check)
+
+
+def test_rejects_unsupported_models():
+    from sklearn.linear_model import LinearRegression
+    X, y = _data()
+    with pytest.raises(ValueError):
+        compile_ensemble(LinearRegression().fit(X, y))
+
+
+def test_predictor_follows_batch_size():
+    from forecast import compiled_is_faster
+
+    # Compiled: cheaper per call, dearer per row; the lines cross at ~1000 rows.
+    report = {
+        "rows_checked": 100,
+        "sklearn": {"row_ms": 2.0, "batch_s": 0.00299},
+        "compiled": {"row_ms": 0.1, "batch_s": 0.00128},
+    }
+    assert compiled_is_faster(report, 1)
+    assert compiled_is_faster(report, 500)
+    assert not compiled_is_faster(report, 5000)
+    # No report (pre-report versions): keep the compiled default.
+    assert compiled_is_faster(None, 5000)
@@ -0,0 +1,190 @@
+import os
+import time
+
+import numpy as np
+import joblib
+
+
+PREDICT_BLOCK_SLOTS = 1 << 16
+
+
+# Flat-array form of a fitted tree ensemble (RandomForestRegressor or
+# HistGradientBoostingRegressor). Every tree's nodes live in shared arrays, so
+# prediction walks all (row, tree) pairs down one level per vectorized step;
+# no per-tree Python calls and no sklearn needed at load or predict time.
+class CompiledTrees:
+
+    def __init__(self, feature, threshold, left, missing_left, value, roots, depth,
+                 combine: str, offset: float, x_dtype: str, n_features: int, source: str):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left            # right child is left + 1; -1 marks a leaf
+        self.missing_left = missing_left
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.combine = combine      # "mean" (forest) or "sum" (boosting)
+        self.offset = offset        # boosting baseline
+        self.x_dtype = x_dtype      # sklearn forests compare float32 features
+        self.n_features = n_features
+        self.source = source
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.value)
+
+    def predict(self, X) -> np.ndarray:
+        X = np.ascontiguousarray(np.asarray(X, dtype=np.float64), dtype=self.x_dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got shape {X.shape}")
+        # Row blocks keep the per-step working arrays cache sized.
+        step = max(1, PREDICT_BLOCK_SLOTS // len(self.roots))
+        out = np.empty(len(X))
+        for lo in range(0, len(X), step):
+            out[lo:lo + step] = self._predict_block(X[lo:lo + step])
+        return out
+
+    def _predict_block(self, X: np.ndarray) -> np.ndarray:
+        n_rows, n_trees = len(X), len(self.roots)
+        x_flat = X.ravel()
+
+        # One slot per (row, tree), walked down one level per step; slots that
+        # reached a leaf drop out of `active`. Siblings are stored side by side,
+        # so the next node is left + (went right).
+        node = np.tile(self.roots, n_rows)
+        x_base = np.repeat(np.arange(n_rows, dtype=np.int32) * self.n_features, n_trees)
+        active = np.flatnonzero(self.left[node] >= 0)
+        while active.size:
+            nd = node[active]
+            x = x_flat[x_base[active] + self.feature[nd]]
+            go_right = ~(x <= self.threshold[nd])
+            missing = np.isnan(x)
+            if missing.any():
+                go_right[missing] = ~self.missing_left[nd[missing]]
+            nd = self.left[nd] + go_right
+            node[active] = nd
+            active = active[self.left[nd] >= 0]
+
+        leaves = self.value[node].reshape(n_rows, n_trees)
+        out = leaves.mean(axis=1) if self.combine == "mean" else leaves.sum(axis=1)
+        return out + self.offset
+
+
+def _sibling_order(left: np.ndarray, right: np.ndarray, is_leaf: np.ndarray) -> np.ndarray:
+    """Breadth-first node order in which every right child directly follows its
+    left sibling."""
+    order, frontier = [np.array([0])], np.array([0])
+    while frontier.size:
+        inner = frontier[~is_leaf[frontier]]
+        frontier = np.column_stack([left[inner], right[inner]]).ravel()
+        order.append(frontier)
+    return np.concatenate(order)
+
+def _pack(trees: list, **kw) -> CompiledTrees:
+    """trees: per-tree (feature, threshold, left, right, missing_left, value, is_leaf)
+    with local node indices. Nodes are renumbered into sibling order and
+    concatenated; leaves get left = -1."""
+    parts, roots, start = [], [], 0
+    for feature, threshold, left, right, missing_left, value, is_leaf in trees:
+        order = _sibling_order(left, right, is_leaf)
+        new_id = np.empty(len(value), dtype=np.int64)
+        new_id[order] = np.arange(len(order)) + start
+        leaf = is_leaf[order]
+        parts.append((
+            np.where(leaf, 0, feature[order]),
+            threshold[order],
+            np.where(leaf, -1, new_id[np.where(leaf, 0, left[order])]),
+            missing_left[order],
+            value[order],
+        ))
+        roots.append(start)
+        start += len(order)
+
+    cat = lambda i: np.concatenate([p[i] for p in parts])
+    return CompiledTrees(
+        feature=cat(0).astype(np.int16),
+        threshold=cat(1).astype(np.float64),
+        left=cat(2).astype(np.int32),
+        missing_left=cat(3).astype(bool),
+        value=cat(4).astype(np.float64),
+        roots=np.asarray(roots, dtype=np.int32),
+        **kw,
+    )
+
+def _compile_forest(model) -> CompiledTrees:
+    trees, depth = [], 0
+    for est in model.estimators_:
+        t = est.tree_
+        is_leaf = t.children_left == -1
+        missing = getattr(t, "missing_go_to_left", None)
+        trees.append((
+            t.feature, t.threshold, t.children_left, t.children_right,
+            np.zeros(t.node_count, dtype=bool) if missing is None else missing.astype(bool),
+            t.value.reshape(t.node_count, -1)[:, 0], is_leaf,
+        ))
+        depth = max(depth, int(t.max_depth))
+    return _pack(trees, depth=depth, combine="mean", offset=0.0, x_dtype="float32",
+                 n_features=int(model.n_features_in_), source=type(model).__name__)
+
+def _compile_hgb(model) -> CompiledTrees:
+    if getattr(model, "_preprocessor", None) is not None or model.n_trees_per_iteration_ != 1:
+        raise ValueError("Categorical or multi-output boosting is not supported")
+
+    trees, depth = [], 0
+    for (predictor,) in model._predictors:
+        n = predictor.nodes
+        trees.append((
+            n["feature_idx"], n["num_threshold"], n["left"].astype(np.int64), n["right"].astype(np.int64),
+            n["missing_go_to_left"], n["value"], n["is_leaf"].astype(bool),
+        ))
+        depth = max(depth, int(n["depth"].max()))
+    return _pack(trees, depth=depth, combine="sum", offset=float(np.ravel(model._baseline_prediction)[0]),
+                 x_dtype="float64", n_features=int(model.n_features_in_), source=type(model).__name__)
+
+def compile_ensemble(model) -> CompiledTrees:
+    name = type(model).__name__
+    if name == "RandomForestRegressor":
+        return _compile_forest(model)
+    if name == "HistGradientBoostingRegressor":
+        return _compile_hgb(model)
+    raise ValueError(f"Cannot compile {name}")
+
+
+# ---------------- Verification / report ----------------
+COMPILE_TOLERANCE = float(os.getenv("ML_COMPILE_TOLERANCE", "1e-6"))
+
+def _latency(predict, X, repeats: int) -> dict:
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        predict(X)
+    batch_s = (time.perf_counter() - t0) / repeats
+
+    n = min(len(X), 50)
+    t0 = time.perf_counter()
+    for i in range(n):
+        predict(X.iloc[i:i + 1] if hasattr(X, "iloc") else X[i:i + 1])
+    row_s = (time.perf_counter() - t0) / n
+    return {"batch_s": round(batch_s, 5), "row_ms": round(row_s * 1000, 4)}
+
+def compare_compiled(model, compiled: CompiledTrees, X, repeats: int = 3) -> dict:
+    """Check compiled predictions against sklearn on X (rows as the model was
+    fit on, DataFrame or array) and time batch and single-row predict for both."""
+    if not len(X):
+        return {"max_abs_diff": None, "tolerance": COMPILE_TOLERANCE, "matches": False, "rows_checked": 0}
+    diff = float(np.max(np.abs(model.predict(X) - compiled.predict(X))))
+    return {
+        "max_abs_diff": diff,
+        "tolerance": COMPILE_TOLERANCE,
+        "matches": diff <= COMPILE_TOLERANCE,
+        "rows_checked": int(len(X)),
+        "nodes": compiled.n_nodes,
+        "trees": int(len(compiled.roots)),
+        "depth": compiled.depth,
+        "sklearn": _latency(model.predict, X, repeats),
+        "compiled": _latency(compiled.predict, X, repeats),
+    }
+
+def artifact_stats(path: str) -> dict:
+    t0 = time.perf_counter()
+    joblib.load(path)
+    return {"bytes": os.path.getsize(path), "load_s": round(time.perf_counter() - t0, 4)}
@@ -0,0 +1,45 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+# Incremental readers scan rows above an auto-increment high-water mark. Ids are
+# allocated at insert time but become visible at commit, so a row can appear
+# below ids already read; jumping the mark to the largest id read would skip it
+# for good. The mark therefore only moves up to rows older than a settle delay
+# (by then every insert that took an id before them has committed or rolled
+# back), and the younger rows above it, already folded in, are remembered and
+# skipped when the next run reads the margin again.
+WATERMARK_SETTLE_S = float(os.getenv("ML_WATERMARK_SETTLE_S", "300"))
+
+
+def settled_before(settle_s: float = None, now: datetime = None) -> datetime:
+    """Rows created before this have settled."""
+    return (now or datetime.now()) - timedelta(seconds=WATERMARK_SETTLE_S if settle_s is None else settle_s)
+
+
+class WatermarkScan:
+    """One pass over the rows above `mark`. `recent` holds the ids above the
+    mark that earlier passes already folded in."""
+
+    def __init__(self, mark: int, recent=(), settle_s: float = None, now: datetime = None):
+        self.mark = int(mark)
+        self.recent = np.asarray(recent, dtype=np.int64)
+        self.settled_before = np.datetime64(settled_before(settle_s, now), "s")
+        self._max_settled = self.mark
+        self._young = []
+
+    def new_rows(self, ids, created_at) -> np.ndarray:
+        """Mask of the rows (id, created_at) not folded in by an earlier pass."""
+        ids = np.asarray(ids, dtype=np.int64)
+        settled = np.asarray(created_at, dtype="datetime64[s]") < self.settled_before
+        if settled.any():
+            self._max_settled = max(self._max_settled, int(ids[settled].max()))
+        self._young.append(ids[~settled])
+        return ~np.isin(ids, self.recent)
+
+    def result(self) -> tuple:
+        """(new mark, ids above it that have been folded in)."""
+        young = np.unique(np.concatenate(self._young)) if self._young else np.empty(0, dtype=np.int64)
+        return self._max_settled, young[young > self._max_settled]
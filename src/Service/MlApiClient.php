@@ -2,13 +2,22 @@
 
 namespace App\Service;
 
+use Psr\Cache\CacheItemPoolInterface;
 use Symfony\Contracts\HttpClient\HttpClientInterface;
 
 class MlApiClient
 {
+    /** Endpoints that can run as background jobs (?background=true). */
+    private const JOB_PATHS = [
+        'train_forecast' => '/train/forecast',
+        'refresh_forecasts' => '/refresh/forecasts',
+        'refresh_recommendations' => '/refresh/recommendations',
+    ];
+
     public function __construct(
         private HttpClientInterface $http,
-        private string $baseUrl
+        private string $baseUrl,
+        private ?CacheItemPoolInterface $cache = null
     ) {}
 
     /**
@@ -30,8 +39,27 @@ class MlApiClient
      */
     public function getRecommendations(int $productId, int $k = 6): array
     {
-        $res = $this->http->request('GET', rtrim($this->baseUrl, '/') . "/recommend/$productId", [
-            'query' => ['k' => $k],
+        return $this->conditionalGet("/recommend/$productId", ['k' => $k], 10);
+    }
+
+    /**
+     * @return array<string, mixed>
+     */
+    public function getForecast(int $productId, int $days = 7): array
+    {
+        return $this->conditionalGet("/forecast/$productId", ['days' => $days], 10);
+    }
+
+    /**
+     * One request for a whole listing page: recommendations keyed by product id.
+     *
+     * @param int[] $productIds
+     * @return array<string, mixed>
+     */
+    public function getRecommendationsBatch(array $productIds, int $k = 6): array
+    {
+        $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/recommend/batch", [
+            'json' => ['product_ids' => array_values(array_map('intval', $productIds)), 'k' => $k],
             'timeout' => 10,
         ]);
 
@@ -41,12 +69,39 @@ class MlApiClient
     }
 
     /**
+     * Recommendations for a whole cart: products ranked by summed similarity to
+     * every cart item, never the cart items themselves or $exclude.
+     *
+     * @param int[] $productIds
+     * @param int[] $exclude
      * @return array<string, mixed>
      */
-    public function getForecast(int $productId, int $days = 7): array
+    public function getCartRecommendations(array $productIds, array $exclude = [], int $k = 6): array
     {
-        $res = $this->http->request('GET', rtrim($this->baseUrl, '/') . "/forecast/$productId", [
-            'query' => ['days' => $days],
+        $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/recommend/cart", [
+            'json' => [
+                'product_ids' => array_values(array_map('intval', $productIds)),
+                'exclude' => array_values(array_map('intval', $exclude)),
+                'k' => $k,
+            ],
+            'timeout' => 5,
+        ]);
+
+        /** @var array<string, mixed> $out */
+        $out = $res->toArray(false);
+        return $out;
+    }
+
+    /**
+     * One request for a whole listing page: forecasts for every product that has one.
+     *
+     * @param int[] $productIds
+     * @return array<string, mixed>
+     */
+    public function getForecasts(array $productIds, int $days = 7): array
+    {
+        $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/forecast/batch", [
+            'json' => ['product_ids' => array_values(array_map('intval', $productIds)), 'days' => $days],
             'timeout' => 10,
         ]);
 
@@ -56,12 +111,13 @@ class MlApiClient
     }
 
     /**
+     * @param bool $rebuild recompute from every order instead of only orders since the last refresh
      * @return array<string, mixed>
      */
-    public function refreshRecommendations(int $k = 6): array
+    public function refreshRecommendations(int $k = 6, bool $rebuild = false): array
     {
         $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/refresh/recommendations", [
-            'query' => ['k' => $k],
+            'query' => ['k' => $k, 'rebuild' => $rebuild ? 'true' : 'false'],
             'timeout' => 60,
         ]);
 
@@ -71,13 +127,20 @@ class MlApiClient
     }
 
     /**
+     * @param int[] $horizons several horizons (e.g. [7, 14, 30]) computed in one pass; overrides $forecastDays
+     * @param bool $full recompute every product, not only those whose sales or stock changed since the last run
      * @return array<string, mixed>
      */
-    public function refreshForecasts(int $forecastDays = 7): array
+    public function refreshForecasts(int $forecastDays = 7, array $horizons = [], bool $full = false): array
     {
+        $query = ['forecast_days' => $forecastDays, 'full' => $full ? 'true' : 'false'];
+        if ($horizons !== []) {
+            $query['horizons'] = implode(',', array_map('intval', $horizons));
+        }
+
         $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/refresh/forecasts", [
-            'query' => ['forecast_days' => $forecastDays],
-            'timeout' => 120,
+            'query' => $query,
+            'timeout' => 30,
         ]);
 
         /** @var array<string, mixed> $out */
@@ -88,12 +151,13 @@ class MlApiClient
     /**
      * @return array<string, mixed>
      */
-    public function trainForecastModel(int $lookbackDays = 365, int $holdoutDays = 30): array
+    public function trainForecastModel(int $lookbackDays = 365, int $holdoutDays = 30, bool $onlyIfDrifted = false): array
     {
         $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . "/train/forecast", [
             'query' => [
                 'lookback_days' => $lookbackDays,
                 'eval_holdout_days' => $holdoutDays,
+                'only_if_drifted' => $onlyIfDrifted ? 'true' : 'false',
             ],
             'timeout' => 300,
         ]);
@@ -102,4 +166,89 @@ class MlApiClient
         $out = $res->toArray(false);
         return $out;
     }
-}
\ No newline at end of file
+
+    /**
+     * Queue a train/refresh job and return immediately with its id (poll with getJob()).
+     * A job of the same kind and parameters that is already running is returned instead.
+     *
+     * @param array<string, mixed> $query
+     * @return array<string, mixed>
+     */
+    public function startJob(string $kind, array $query = []): array
+    {
+        if (!isset(self::JOB_PATHS[$kind])) {
+            throw new \InvalidArgumentException("Unknown ML job kind: $kind");
+        }
+
+        $res = $this->http->request('POST', rtrim($this->baseUrl, '/') . self::JOB_PATHS[$kind], [
+            'query' => $query + ['background' => 'true'],
+            'timeout' => 10,
+        ]);
+
+        /** @var array<string, mixed> $out */
+        $out = $res->toArray(false);
+        return $out;
+    }
+
+    /**
+     * @return array<string, mixed>
+     */
+    public function getJob(string $jobId): array
+    {
+        $res = $this->http->request('GET', rtrim($this->baseUrl, '/') . "/jobs/$jobId", [
+            'timeout' => 5,
+        ]);
+
+        /** @var array<string, mixed> $out */
+        $out = $res->toArray(false);
+        return $out;
+    }
+
+    /**
+     * GET that revalidates a cached copy with If-None-Match / If-Modified-Since:
+     * a 304 from the ML API returns the cached body without re-downloading it.
+     * Without a cache pool this is a plain GET.
+     *
+     * @param array<string, mixed> $query
+     * @return array<string, mixed>
+     */
+    private function conditionalGet(string $path, array $query, int $timeout): array
+    {
+        $item = $this->cache?->getItem('ml_api.' . sha1($path . '?' . http_build_query($query)));
+        /** @var array{etag: ?string, last_modified: ?string, body: array<string, mixed>}|null $cached */
+        $cached = $item !== null && $item->isHit() ? $item->get() : null;
+
+        $headers = [];
+        if ($cached !== null) {
+            if ($cached['etag'] !== null) {
+                $headers['If-None-Match'] = $cached['etag'];
+            }
+            if ($cached['last_modified'] !== null) {
+                $headers['If-Modified-Since'] = $cached['last_modified'];
+            }
+        }
+
+        $res = $this->http->request('GET', rtrim($this->baseUrl, '/') . $path, [
+            'query' => $query,
+            'headers' => $headers,
+            'timeout' => $timeout,
+        ]);
+
+        if ($cached !== null && $res->getStatusCode() === 304) {
+            return $cached['body'];
+        }
+
+        /** @var array<string, mixed> $out */
+        $out = $res->toArray(false);
+
+        $responseHeaders = $res->getHeaders(false);
+        $etag = $responseHeaders['etag'][0] ?? null;
+        $lastModified = $responseHeaders['last-modified'][0] ?? null;
+        if ($item !== null && $res->getStatusCode() === 200 && ($etag !== null || $lastModified !== null)) {
+            $item->set(['etag' => $etag, 'last_modified' => $lastModified, 'body' => $out]);
+            $this->cache?->save($item);
+        }
+
+        return $out;
+    }
+}